@@ -1,29 +1,43 @@
 #!/usr/bin/env python3
 
 import re
-import pyasn
 import socket
 import argparse
 import json
-import uuid
+import zlib
+import time
+import threading
 import os
+import base64
+import hashlib
+import functools
+import math
+
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from datetime import datetime, timedelta
 
-from flask import jsonify
+from flask import jsonify, request, make_response
 from flask_api import FlaskAPI, status
 from pymongo import ASCENDING, DESCENDING
-from pymongo.errors import DuplicateKeyError, ServerSelectionTimeoutError
+from pymongo.errors import BulkWriteError, OperationFailure, ServerSelectionTimeoutError
 from werkzeug.exceptions import NotFound, BadRequest, BadGateway, MethodNotAllowed, RequestEntityTooLarge, InternalServerError
 from werkzeug.routing import PathConverter
 from logging.config import dictConfig
-from flask_pymongo import PyMongo
-from rejson import Client, Path
+from redis import Redis
+from redis.exceptions import ResponseError, LockError
 from bson import json_util
+from bson.objectid import ObjectId
 
+from tools.utils.connection import configure, connect
+from tools.utils.asn_lookup import lookup_many
 from tools.utils.extract_graph import extract_graph
-from tools.utils.extract_geodata import read_dataframe
-from tools.utils.update_entry import handle_query
+from tools.utils.extract_certificate import certificates_migrated
+from tools.utils.extract_geodata import read_dataframe, lookup_geodata_many
+from tools.utils.enrichment_queue import enqueue, enqueue_many, is_pending, consume_done
+from tools.utils.generate_qrcode import qrcode_png
+from tools.utils.ip_index import ip_to_int, count_domains, find_addresses, update_addresses
+from tools.utils.prefix_index import PREFIX_MODES, parse_network, prefix_queries, address_query
 
 
 dictConfig({
@@ -47,7 +61,17 @@ app = FlaskAPI(__name__, static_folder=None)
 
 app.config.from_pyfile('config.cfg')
 
-mongo = PyMongo(app)
+configure(app.config.get('MONGO_URI'))
+
+
+class Database:
+    # requests and the tools they call share one client per process
+    @property
+    def db(self):
+        return connect().get_default_database()
+
+
+mongo = Database()
 
 
 class EverythingConverter(PathConverter):
@@ -105,490 +129,879 @@ def handle_server_selection_timeout(e):
     return jsonify(message='Something went wrong application error'), 500
 
 
-def connect_cache():
-    return Client(host='127.0.0.1', port=6379, decode_responses=True)
+DOCUMENT_FILTER = {'_id': 0, 'qrcode': 0}
+
+IP_FIELDS = ['ip', 'host', 'asn', 'name', 'prefix', 'geo', 'domains', 'updated']
+
+FIELD_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9_-]*(\.[A-Za-z0-9_-]+)*$')
+
+DATE_FIELDS = ['created', 'updated', 'domain_crawled', 'header_scan_failed', 'ssl.not_after', 'ssl.not_before']
+
+EPOCH = datetime(1970, 1, 1)
+
+DOMAIN_PATTERN = re.compile(r'^(?=.{1,253}$)([a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?\.)+[a-z0-9-]{2,63}$')
 
 
-def fetch_one_ip(ip):
-    query = {'a_record': {'$in': [ip]}}
-    filter = {'_id': 0}
+def connect_cache():
+    return Redis(host='127.0.0.1', port=6379)
 
 
 def cache_key(key):
     return re.sub(r'[\\\/\(\)\'\"\[\],;:#+~\. ]', '-', key)
 
 
-def extra_fields(context):
-    data = {'created_formatted': {'$dateToString': {'format': '%Y-%m-%d %H:%M:%S', 'date': '$created'}},
-            'updated_formatted': {'$dateToString': {'format': '%Y-%m-%d %H:%M:%S', 'date': '$updated'}},
-            'domain_crawled_formatted': {'$dateToString': {'format': '%Y-%m-%d %H:%M:%S', 'date': '$domain_crawled'}},
-            'header_scan_failed_formatted': {'$dateToString': {'format': '%Y-%m-%d %H:%M:%S', 'date': '$header_scan_failed'}},
-            'ssl.not_after_formatted': {'$dateToString': {'format': '%Y-%m-%d %H:%M:%S', 'date': '$ssl.not_after'}},
-            'ssl.not_before_formatted': {'$dateToString': {'format': '%Y-%m-%d %H:%M:%S', 'date': '$ssl.not_before'}}}
+def included_fields(filter):
+    return [k for k, v in filter.items() if k != '_id' and v not in [0, False]]
 
-    if context == 'text':
-        data['score'] = {'$meta': "textScore"}
+
+def covered(field, fields):
+    return any(field == f or field.startswith(f + '.') for f in fields)
+
+
+def overlaps(field, fields):
+    return any(field == f or field.startswith(f + '.') or f.startswith(field + '.') for f in fields)
+
+
+def parse_fields(value):
+    if not value:
+        return None
+
+    fields = sorted(set(f.strip() for f in value.split(',') if f.strip()))
+
+    if len(fields) > app.config.get('FIELDS_LIMIT', 30) or not all(FIELD_PATTERN.match(f) for f in fields):
+        raise BadRequest('invalid fields')
+
+    # a parent path already includes its children and mongodb rejects the collision
+    fields = [f for f in fields if not covered(f, [o for o in fields if o != f]) and not covered(f, ['qrcode'])]
+
+    return fields or None
+
+
+def field_filter(fields):
+    if not fields:
+        return DOCUMENT_FILTER
+
+    filter = dict({'_id': 0}, **dict.fromkeys(fields, 1))
+
+    for field in DATE_FIELDS:
+        if covered(field, fields) and not covered(field + '_formatted', fields):
+            filter[field + '_formatted'] = 1
+
+    return filter
+
+
+def projection_key(key, fields):
+    if not fields:
+        return key
+
+    return '{}-{}'.format(key, hashlib.sha1(','.join(fields).encode('utf-8')).hexdigest())
+
+
+def extra_fields(context, filter):
+    fields = included_fields(filter)
+    data = {}
+
+    for field in DATE_FIELDS:
+        name = field + '_formatted'
+
+        if not fields or covered(name, fields):
+            data[name] = {'$dateToString': {'format': '%Y-%m-%d %H:%M:%S', 'date': '$' + field}}
 
     return data
 
 
-def fetch_from_cache(query, filter, unwind, sort, limit, context, reset, cache_key):
+def encode_cursor(position):
+    key = position.get('k')
+    data = {'i': str(position['i'])}
+
+    if isinstance(key, datetime):
+        data['d'] = (key - EPOCH) // timedelta(milliseconds=1)
+    elif key is not None:
+        data['n'] = key
+
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii')
+
+
+def cursor_key(data):
+    # the cursor is not signed, only plain sort values may reach keyset_query
+    if 'd' in data:
+        if not isinstance(data['d'], int) or isinstance(data['d'], bool):
+            raise ValueError('invalid date')
+
+        return EPOCH + timedelta(milliseconds=data['d'])
+
+    if 'n' in data:
+        if not isinstance(data['n'], (int, float)) or isinstance(data['n'], bool) or not math.isfinite(data['n']):
+            raise ValueError('invalid number')
+
+        return data['n']
+
+    return None
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+
+        if not isinstance(data, dict) or not isinstance(data.get('i'), str) or not ObjectId.is_valid(data['i']):
+            raise ValueError('invalid id')
+
+        return {'k': cursor_key(data), 'i': ObjectId(data['i'])}
+    except (ValueError, TypeError, OverflowError):
+        raise BadRequest('invalid cursor')
+
+
+def keyset_query(key, position):
+    if position.get('k') is None:
+        return {key: None, '_id': {'$lt': position['i']}}
+
+    # documents without a sort value come last in a descending sort
+    return {'$or': [{key: {'$lt': position['k']}}, {key: position['k'], '_id': {'$lt': position['i']}}, {key: None}]}
+
+
+def cursor_projection(filter):
+    if included_fields(filter):
+        return dict(filter, _cursor=1)
+
+    return filter
+
+
+def certificate_field(field):
+    return field.startswith('ssl.')
+
+
+def certificate_stages(filter):
+    fields = included_fields(filter)
+
+    if fields and not overlaps('ssl', fields):
+        return []
+
+    # documents not yet migrated keep their embedded ssl subdocument, the bookkeeping
+    # fields of the certificates collection are dropped before any inclusion projection
+    return [{'$lookup': {'from': 'certificates', 'localField': 'certificate', 'foreignField': '_id', 'as': '_certificate'}},
+            {'$addFields': {'ssl': {'$ifNull': [{'$arrayElemAt': ['$_certificate', 0]}, '$ssl']}}},
+            {'$project': {'_certificate': 0, 'ssl._id': 0, 'ssl.created': 0, 'ssl.updated': 0, 'ssl.fingerprint': 0}}]
+
+
+def page_cursor(docs, limit):
+    cursors = [doc.pop('_cursor', None) for doc in docs]
+    ids = set(c['i'] for c in cursors if c)
+
+    if len(ids) < limit:
+        return None
+
+    return encode_cursor(cursors[-1])
+
+
+def build_pipeline(query, filter, unwind, sort, limit, context, position=None, joined=None):
+    if context == 'spatial':
+        return [{'$geoNear': query}, {'$limit': limit}] + certificate_stages(filter) + [
+                {'$addFields': extra_fields(context, filter)}, {'$sort': sort}, {'$project': filter}]
+
+    key = next(iter(sort))
+    pipeline = [{'$match': query}]
+
+    if context == 'text':
+        pipeline.append({'$addFields': {key: {'$meta': 'textScore'}}})
+
+    if position:
+        pipeline.append({'$match': keyset_query(key, position)})
+
+    pipeline.append({'$sort': {key: -1, '_id': -1}})
+
+    # the scan follows the sort index and stops as soon as the page is full
+    if joined:
+        pipeline += [{'$lookup': {'from': 'certificates', 'localField': 'certificate', 'foreignField': '_id', 'as': '_certificate'}},
+                     {'$match': joined}]
+
+    pipeline.append({'$limit': limit})
+
+    if context == 'unwind':
+        pipeline.append({'$unwind': unwind})
+
+    return pipeline + certificate_stages(filter) + [
+        {'$addFields': dict(extra_fields(context, filter), _cursor={'k': '$' + key, 'i': '$_id'})},
+        {'$project': cursor_projection(filter)}]
+
+
+def dump_cache(docs, next_cursor, stale):
+    data = json.dumps({'stale': stale, 'docs': docs, 'next': next_cursor},
+                      default=json_util.default).encode('utf-8')
+
+    # the tags change whenever cached pages change shape, older entries are then recomputed
+    if app.config.get('CACHE_COMPRESS', True):
+        return b'c' + zlib.compress(data)
+
+    return b'p' + data
+
+
+def load_cache(data):
+    if data[:1] == b'c':
+        return json.loads(zlib.decompress(data[1:]).decode('utf-8'))
+
+    if data[:1] == b'p':
+        return json.loads(data[1:].decode('utf-8'))
+
+    raise ValueError('outdated cache entry')
+
+
+def read_cache(cache_key):
+    try:
+        data = cache.get(cache_key)
+    except ResponseError:
+        cache.delete(cache_key)
+        return None
+
+    if data is None:
+        return None
+
+    try:
+        return load_cache(data)
+    except (ValueError, zlib.error):
+        cache.delete(cache_key)
+        return None
+
+
+def cache_lock(cache_key):
+    return cache.lock('lock-{}'.format(cache_key), timeout=app.config.get('CACHE_LOCK_TIMEOUT', 30))
+
+
+def release_lock(lock):
+    try:
+        lock.release()
+    except LockError:
+        pass
+
+
+def run_pipeline(query, filter, unwind, sort, limit, context, hint=None, position=None, joined=None):
+    pipeline = build_pipeline(query, filter, unwind, sort, limit, context, position, joined)
+
+    if hint:
+        return mongo.db.dns.aggregate(pipeline, hint=hint)
+
+    return mongo.db.dns.aggregate(pipeline)
+
+
+def sort_position(doc):
+    key = doc['_cursor'].get('k')
+
+    return key is not None, key, doc['_cursor']['i']
+
+
+def aggregate(query, filter, unwind, sort, limit, context, hint=None, position=None):
+    if not callable(query):
+        return run_pipeline(query, filter, unwind, sort, limit, context, hint, position)
+
+    # the queries match disjoint documents, each page is merged from their first pages
+    docs = []
+
+    for match, match_hint, joined in query(paged=True):
+        docs += run_pipeline(match, filter, unwind, sort, limit, context, match_hint, position, joined)
+
+    return sorted(docs, key=sort_position, reverse=True)[:limit]
+
+
+def compute_cache(query, filter, unwind, sort, limit, context, cache_key, hint=None, position=None):
+    docs = list(aggregate(query, filter, unwind, sort, limit, context, hint, position))
+    next_cursor = page_cursor(docs, limit)
+    store_cache(docs, next_cursor, cache_key)
+
+    return docs, next_cursor
+
+
+def revalidate_cache(query, filter, unwind, sort, limit, context, cache_key, hint=None, position=None):
+    lock = cache_lock(cache_key)
+
+    if not lock.acquire(blocking=False):
+        return None
+
+    try:
+        return compute_cache(query, filter, unwind, sort, limit, context, cache_key, hint, position)
+    except Exception as e:
+        app.logger.error('type: {}, args: {}'.format(type(e).__name__, e.args))
+    finally:
+        release_lock(lock)
+
+
+def schedule_revalidate(args):
+    cache_key = args[6]
+
+    with revalidating_lock:
+        if cache_key in revalidating:
+            return
+
+        revalidating.add(cache_key)
+
+    def done(future):
+        with revalidating_lock:
+            revalidating.discard(cache_key)
+
+    revalidator.submit(revalidate_cache, *args).add_done_callback(done)
+
+
+def wait_for_cache(lock, cache_key):
+    deadline = time.monotonic() + app.config.get('CACHE_LOCK_WAIT', 10)
+
+    while time.monotonic() < deadline:
+        time.sleep(app.config.get('CACHE_LOCK_POLL', 0.05))
+        stored = read_cache(cache_key)
+
+        if stored is not None:
+            return stored
+
+        if not lock.locked():
+            return read_cache(cache_key)
+
+
+def page_key(cache_key, cursor, context):
+    if cursor and context != 'spatial':
+        return '{}-{}'.format(cache_key, hashlib.sha1(cursor.encode('utf-8')).hexdigest())
+
+    return cache_key
+
+
+def fetch_from_cache(query, filter, unwind, sort, limit, context, reset, cache_key, refresh=False, hint=None, cursor=None):
+    position = None
+
+    if cursor and context != 'spatial':
+        position = decode_cursor(cursor)
+        cache_key = page_key(cache_key, cursor, context)
+
+    args = (query, filter, unwind, sort, limit, context, cache_key, hint, position)
+
     if reset:
         cache.delete(cache_key)
 
-    stored = cache.smembers(cache_key)
-    cache_list = []
+    stored = read_cache(cache_key)
 
-    if len(stored) == 0:
-        store_cache(query, filter, unwind, sort, limit, context, cache_key)
+    if refresh:
+        if stored is None or stored['stale'] - time.time() < app.config.get('CACHE_PREWARM_INTERVAL', 600):
+            result = revalidate_cache(*args)
 
-        if context == 'text':
-            return list(mongo.db.dns.aggregate([{'$match': query}, {'$limit': limit},
-                {'$addFields': extra_fields(context)}, {'$project': filter}, {'$sort': sort}]))
-        elif context == 'spatial':
-            return list(mongo.db.dns.aggregate([{'$geoNear': query}, {'$limit': limit},
-                {'$addFields': extra_fields(context)}, {'$project': filter}, {'$sort': sort}]))
-        elif context == 'unwind':
-            return list(mongo.db.dns.aggregate([{'$match': query}, {'$unwind': unwind}, {'$limit': limit},
-                {'$addFields': extra_fields(context)}, {'$project': filter}, {'$sort': sort}]))
-        else:
-            return list(mongo.db.dns.aggregate([{'$match': query}, {'$limit': limit},
-                {'$addFields': extra_fields(context)}, {'$project': filter}, {'$sort': sort}]))
+            if result is not None:
+                return result
 
-    for store in stored:
-        cache_list.append(cache.jsonget(store, Path.rootPath()))
+    if stored is not None:
+        if stored['stale'] < time.time():
+            schedule_revalidate(args)
 
-    return cache_list
+        return stored['docs'], stored['next']
 
-reset = False
+    lock = cache_lock(cache_key)
 
-def store_cache(query, filter, unwind, sort, limit, context, cache_key):
-    if context == 'text':
-        docs = mongo.db.dns.aggregate([{'$match': query}, {'$limit': limit},
-            {'$addFields': extra_fields(context)}, {'$project': filter}, {'$sort': sort}])
-    elif context == 'spatial':
-        docs = mongo.db.dns.aggregate([{'$geoNear': query}, {'$limit': limit},
-            {'$addFields': extra_fields(context)}, {'$project': filter}, {'$sort': sort}])
-    elif context == 'unwind':
-        docs = mongo.db.dns.aggregate([{'$match': query}, {'$unwind': unwind}, {'$limit': limit},
-            {'$addFields': extra_fields(context)}, {'$project': filter}, {'$sort': sort}])
+    if lock.acquire(blocking=False):
+        try:
+            stored = read_cache(cache_key)
+
+            if stored is not None:
+                return stored['docs'], stored['next']
+
+            return compute_cache(*args)
+        finally:
+            release_lock(lock)
+
+    stored = wait_for_cache(lock, cache_key)
+
+    if stored is not None:
+        return stored['docs'], stored['next']
+
+    return compute_cache(*args)
+
+
+def store_cache(docs, next_cursor, cache_key):
+    if docs:
+        stale = app.config.get('CACHE_STALE', 3600)
+        expire = app.config.get('CACHE_EXPIRE', 3600 * 24)
     else:
-        docs = mongo.db.dns.aggregate([{'$match': query}, {'$limit': limit},
-            {'$addFields': extra_fields(context)}, {'$project': filter}, {'$sort': sort}])
+        stale = expire = app.config.get('CACHE_EMPTY_EXPIRE', 60)
 
-    for doc in docs:
-        uid = hash(uuid.uuid4())
-        expire = 3600 * 24
-        cache.jsonset(uid, Path.rootPath(), json.loads(
-            json.dumps(doc, default=json_util.default)))
-        cache.sadd(cache_key, uid)
-        cache.expire(cache_key, expire)
-        cache.expire(uid, expire)
+    cache.set(cache_key, dump_cache(docs, next_cursor, time.time() + stale), ex=expire)
 
 
-def create_index(field_name_1, field_name_2):
+def prewarm_cache():
+    interval = app.config.get('CACHE_PREWARM_INTERVAL', 600)
+
+    while True:
+        # the lock is left to expire, so one worker of the deployment warms the feeds per interval
+        if cache.lock('lock-prewarm', timeout=interval).acquire(blocking=False):
+            for feed in [fetch_latest_dns, fetch_latest_asn, fetch_latest_cidr, fetch_latest_ipv4]:
+                try:
+                    feed(refresh=True)
+                except Exception as e:
+                    app.logger.error('type: {}, args: {}'.format(type(e).__name__, e.args))
+
+        time.sleep(interval)
+
+
+@app.before_first_request
+def start_prewarm():
+    if app.config.get('CACHE_PREWARM', True):
+        threading.Thread(target=prewarm_cache, daemon=True).start()
+
+
+def create_index(field_name_1, field_name_2, indexes):
     mongo.db.dns.create_index(
-        [(field_name_1, DESCENDING), (field_name_2, DESCENDING)], background=True)
+        [(field_name_1, DESCENDING), (field_name_2, DESCENDING), ('_id', DESCENDING)], background=True)
+
+    # the index without the _id tie break is a prefix of the one above
+    superseded = '{}_-1_{}_-1'.format(field_name_1, field_name_2)
+
+    if superseded in indexes:
+        remove_index(superseded)
+
+
+def remove_index(name):
+    # workers import the app at the same time, all but one of them find the index gone
+    try:
+        mongo.db.dns.drop_index(name)
+    except OperationFailure:
+        pass
+
+
+def drop_index(field_name_1, field_name_2, indexes):
+    for name in ['{}_-1_{}_-1__id_-1'.format(field_name_1, field_name_2), '{}_-1_{}_-1'.format(field_name_1, field_name_2)]:
+        if name in indexes:
+            remove_index(name)
+
+
+def match_any(fields, value):
+    if len(fields) == 1:
+        return {fields[0]: value}
+
+    return {'$or': [{field: value} for field in fields]}
+
+
+def match_all(fields, value):
+    return {'$and': [{field: value} for field in fields]}
+
+
+def match_number(fields, value):
+    return match_any(fields, int(value))
+
+
+def match_since(fields, value):
+    return {fields[0]: {'$gte': datetime.strptime(value, '%Y-%m-%d %H:%M:%S')}}
+
+
+def match_until(fields, value):
+    return {fields[0]: {'$lte': datetime.strptime(value, '%Y-%m-%d %H:%M:%S')}}
+
+
+def match_near(fields, value):
+    splited = value.split(',')
+
+    return {'distanceField': 'geo.distance',
+            'near': {'type': 'Point', 'coordinates': [float(splited[0]), float(splited[1])]},
+            'maxDistance': 50000, 'spherical': True}
+
+
+def normalize_value(value):
+    return value
+
+
+def normalize_asn(value):
+    return re.sub(r'[a-zA-Z:]', '', value.lower())
+
 
+def excluding(match, query):
+    if query is None:
+        return match
 
-def fetch_match_condition(condition, query):
+    # documents matching the plain fields are returned by the first query already
+    return {'$and': [match, {'$nor': [query]}]}
+
+
+def certificate_batches(certificate_query):
+    batch_size = app.config.get('CERTIFICATE_BATCH_SIZE', 10000)
+    batch = []
+
+    for doc in mongo.db.certificates.find(certificate_query, {'_id': 1}, batch_size=batch_size):
+        batch.append(doc['_id'])
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def resolve_certificates(query, legacy_query, legacy_hint, certificate_query, joined_query, paged=False):
     if query is not None:
-        if condition == 'registry':
-            sub_query = query.lower()
-
-            query = {'whois.asn_registry': sub_query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'registry-{}'.format(cache_key(sub_query)))
-        elif condition == 'port':
-            sub_query = query
-
-            query = {'ports.port': int(query)}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'port-{}'.format(cache_key(sub_query)))
-        elif condition == 'status':
-            sub_query = query
-
-            query = {'header.status': sub_query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'status-{}'.format(cache_key(sub_query)))
-        elif condition == 'ssl':
-            sub_query = query.lower()
-
-            query = {'$or': [{'ssl.subject.common_name': sub_query},
-                             {'ssl.subject_alt_names': {'$in': [sub_query]}}]}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'ssl-{}'.format(cache_key(sub_query)))
-        elif condition == 'before':
-            sub_query = query.lower()
-
-            query = {'ssl.not_before': {
-                '$gte': datetime.strptime(query, '%Y-%m-%d %H:%M:%S')}}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'before-{}'.format(cache_key(sub_query)))
-        elif condition == 'after':
-            sub_query = query.lower()
-
-            query = {'ssl.not_after': {
-                '$lte': datetime.strptime(query, '%Y-%m-%d %H:%M:%S')}}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'after-{}'.format(cache_key(sub_query)))
-        elif condition == 'ca':
-            sub_query = query.lower()
-
-            query = {'ssl.ca_issuers': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'ca-{}'.format(cache_key(sub_query)))
-        elif condition == 'issuer':
-            sub_query = query.lower()
-
-            query = {'$or': [{'ssl.issuer.organization_name': query},
-                    {'ssl.issuer.common_name': query}]}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'issuer-{}'.format(cache_key(sub_query)))
-        elif condition == 'unit':
-            sub_query = query.lower()
-
-            query = {'$or': [{'ssl.issuer.organizational_unit_name': query},
-                    {'ssl.subject.organizational_unit_name': query}]}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'unit-{}'.format(cache_key(sub_query)))
-        elif condition == 'ocsp':
-            sub_query = query.lower()
-
-            query = {'ssl.ocsp': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'ocsp-{}'.format(cache_key(sub_query)))
-        elif condition == 'crl':
-            sub_query = query.lower()
-
-            query = {'ssl.crl_distribution_points': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'crl-{}'.format(cache_key(sub_query)))
-        elif condition == 'service':
-            sub_query = query.lower()
-
-            query = {'header.x-powered-by': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'service-{}'.format(cache_key(sub_query)))
-        elif condition == 'country':
-            sub_query = query.upper()
-
-            query = {'$and': [{'geo.country_code': query},
-                              {'whois.asn_country_code': query}]}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'country-{}'.format(cache_key(sub_query)))
-        elif condition == 'state':
-            sub_query = query.lower()
-
-            query = {'geo.state': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'state-{}'.format(cache_key(sub_query)))
-        elif condition == 'city':
-            sub_query = query.lower()
-
-            query = {'geo.city': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'city-{}'.format(cache_key(sub_query)))
-        elif condition == 'loc':
-            sub_query = query.lower()
-            splited = query.split(',')
+        yield query, None, None
+
+    # documents not yet migrated keep their embedded ssl subdocument
+    if not certificates_migrated(mongo.db):
+        yield excluding(legacy_query, query), legacy_hint, None
+
+    if paged:
+        batch_size = app.config.get('CERTIFICATE_BATCH_SIZE', 10000)
+        ids = [doc['_id'] for doc in mongo.db.certificates.find(certificate_query, {'_id': 1}).limit(batch_size + 1)]
+
+        # common certificates match too many ids, a page joins them in sort order instead
+        if len(ids) > batch_size:
+            yield excluding({'certificate': {'$exists': True}}, query), 'updated_-1__id_-1', joined_query
+        elif ids:
+            yield excluding({'certificate': {'$in': ids}}, query), 'certificate_-1_updated_-1__id_-1', None
+
+        return
+
+    for ids in certificate_batches(certificate_query):
+        yield excluding({'certificate': {'$in': ids}}, query), 'certificate_-1_updated_-1__id_-1', None
+
+
+def certificate_query(spec, value):
+    fields = [field for field in spec['fields'] if not certificate_field(field)]
+    ssl_fields = [field for field in spec['fields'] if certificate_field(field)]
+    certificate_fields = [field[len('ssl.'):] for field in ssl_fields]
+    query = spec['query'](fields, value) if fields else None
+    legacy_hint = '{}_-1_updated_-1__id_-1'.format(ssl_fields[0]) if spec['index'] and len(ssl_fields) == 1 else None
+
+    # resolved on a cache miss only, see aggregate and export_pipelines
+    return functools.partial(resolve_certificates, query, spec['query'](ssl_fields, value), legacy_hint,
+                             spec['query'](certificate_fields, value),
+                             spec['query'](['_certificate.' + field for field in certificate_fields], value))
+
+
+def attach_certificates(docs):
+    ids = [doc['certificate'] for doc in docs if doc and 'certificate' in doc]
+
+    if not ids:
+        return docs
+
+    certificates = {cert.pop('_id'): cert for cert in mongo.db.certificates.find({'_id': {'$in': ids}})}
+
+    for doc in docs:
+        if doc and doc.get('certificate') in certificates:
+            doc['ssl'] = certificates[doc['certificate']]
+
+    return docs
+
+
+def fetch_condition(spec, query, key, cursor=None, reset=False, fields=None):
+    return fetch_from_cache(query, field_filter(fields), False, {'updated': -1}, 30, spec['context'],
+                            reset, projection_key(key, fields), hint=spec['hint'], cursor=cursor)
+
+
+def incomplete_site(result, fields=None):
+    required_keys = [k for k in ['a_record', 'geo'] if not fields or overlaps(k, fields)]
+
+    return len(result) == 0 or (len(result) == 1 and any(k not in result[0] for k in required_keys))
+
+
+def track_site(value, cache_key):
+    pipe = cache.pipeline(transaction=False)
+    pipe.sadd('site-keys-{}'.format(value), cache_key)
+    pipe.expire('site-keys-{}'.format(value), app.config.get('CACHE_EXPIRE', 3600 * 24))
+    pipe.execute()
+
+
+def invalidate_site(value):
+    pipe = cache.pipeline()
+    pipe.smembers('site-keys-{}'.format(value))
+    pipe.delete('site-keys-{}'.format(value))
+    keys, _ = pipe.execute()
+
+    if keys:
+        cache.delete(*keys)
+
+
+def fetch_site(spec, query, key, value, cursor=None, fields=None):
+    result, next_cursor = fetch_condition(spec, query, key, cursor, fields=fields)
+
+    if not DOMAIN_PATTERN.match(value):
+        return result, next_cursor
+
+    # every fields and cursor variant of a site is cached apart, enrichment refreshes them all
+    track_site(value, page_key(projection_key(key, fields), cursor, spec['context']))
+
+    if not incomplete_site(result, fields):
+        return result, next_cursor
+
+    if consume_done(cache, value):
+        invalidate_site(value)
+        result, next_cursor = fetch_condition(spec, query, key, cursor, True, fields)
+
+        if not incomplete_site(result, fields):
+            return result, next_cursor
+
+    if enqueue(cache, value) or is_pending(cache, value):
+        result = [dict(doc, enrichment='pending') for doc in result] or [{'domain': value, 'enrichment': 'pending'}]
+
+    return result, next_cursor
+
+
+def condition(name, fields, query=match_any, normalize=normalize_value, context='normal',
+              greedy=False, index=True, fetch=None):
+    hint = None
+
+    # certificate queries carry a hint per resolved query, see resolve_certificates
+    if index and context == 'normal' and len(fields) == 1 and not certificate_field(fields[0]):
+        hint = '{}_-1_updated_-1__id_-1'.format(fields[0])
+
+    return {'name': name, 'fields': fields, 'query': query, 'normalize': normalize,
+            'context': context, 'greedy': greedy, 'index': index, 'hint': hint,
+            'prefix': name, 'fetch': fetch}
+
+
+def validate_conditions(conditions):
+    registry = {}
+
+    for spec in conditions:
+        if spec['name'] in registry:
+            raise ValueError('duplicate match condition {}'.format(spec['name']))
+
+        if not spec['fields'] or not all(isinstance(f, str) for f in spec['fields']):
+            raise ValueError('match condition {} needs field paths'.format(spec['name']))
+
+        if not callable(spec['query']) or not callable(spec['normalize']):
+            raise ValueError('match condition {} needs a query builder and normalizer'.format(spec['name']))
+
+        if spec['context'] not in ['normal', 'spatial']:
+            raise ValueError('match condition {} has unknown context {}'.format(spec['name'], spec['context']))
+
+        registry[spec['name']] = spec
+
+    if len(set(spec['prefix'] for spec in conditions)) != len(conditions):
+        raise ValueError('match condition cache prefixes must be unique')
+
+    return registry
+
+
+MATCH_CONDITIONS = validate_conditions([
+    condition('registry', ['whois.asn_registry'], normalize=str.lower),
+    condition('port', ['ports.port'], query=match_number),
+    condition('status', ['header.status']),
+    condition('ssl', ['ssl.subject.common_name', 'ssl.subject_alt_names'], normalize=str.lower),
+    condition('before', ['ssl.not_before'], query=match_since, greedy=True),
+    condition('after', ['ssl.not_after'], query=match_until, greedy=True),
+    condition('ca', ['ssl.ca_issuers'], greedy=True),
+    condition('issuer', ['ssl.issuer.organization_name', 'ssl.issuer.common_name']),
+    condition('unit', ['ssl.issuer.organizational_unit_name', 'ssl.subject.organizational_unit_name']),
+    condition('ocsp', ['ssl.ocsp'], greedy=True),
+    condition('crl', ['ssl.crl_distribution_points'], greedy=True),
+    condition('service', ['header.x-powered-by']),
+    condition('country', ['geo.country_code', 'whois.asn_country_code'], query=match_all, normalize=str.upper),
+    condition('state', ['geo.state']),
+    condition('city', ['geo.city']),
+    condition('loc', ['geo.loc.coordinates'], query=match_near, context='spatial'),
+    condition('banner', ['banner']),
+    condition('asn', ['whois.asn'], normalize=normalize_asn),
+    condition('org', ['whois.asn_description', 'ssl.subject.organization_name'], greedy=True),
+    condition('cidr', ['whois.asn_cidr']),
+    condition('cname', ['cname_record.target'], normalize=str.lower),
+    condition('mx', ['mx_record.exchange'], normalize=str.lower),
+    condition('ns', ['ns_record'], normalize=str.lower),
+    condition('server', ['header.server']),
+    condition('site', ['domain'], normalize=str.lower, fetch=fetch_site),
+    condition('ipv4', ['a_record']),
+    condition('ipv6', ['aaaa_record'], greedy=True)
+])
+
+
+def parse_condition(path):
+    ql = path.split(':')
+    spec = MATCH_CONDITIONS.get(ql[0].lower())
+
+    if spec is None or len(ql) < 2:
+        return None, None
+
+    if spec['greedy']:
+        return spec['name'], ':'.join(ql[1:])
+
+    return spec['name'], ql[1]
+
+
+def match_query(condition, value):
+    spec = MATCH_CONDITIONS.get(condition)
+
+    if spec is None or value is None:
+        return None, None, None
+
+    value = spec['normalize'](value)
+
+    try:
+        if any(certificate_field(field) for field in spec['fields']):
+            return spec, certificate_query(spec, value), value
+
+        return spec, spec['query'](spec['fields'], value), value
+    except (ValueError, IndexError):
+        return None, None, None
+
+
+def export_pipelines(spec, query):
+    filter = DOCUMENT_FILTER
+    stages = certificate_stages(filter) + [{'$project': filter}]
+
+    if spec['context'] == 'spatial':
+        yield [{'$geoNear': query}] + stages
+        return
+
+    # certificate matches resolve lazily, one pipeline per batch of certificates
+    queries = query() if callable(query) else [(query, spec['hint'], None)]
+
+    for match, hint, joined in queries:
+        yield [{'$match': match}] + stages
+
+
+def fetch_match_condition(condition, value, cursor=None, fields=None):
+    spec, query, value = match_query(condition, value)
+
+    if spec is None:
+        return [], None
+
+    key = '{}-{}'.format(spec['prefix'], cache_key(value))
+
+    if spec['fetch']:
+        return spec['fetch'](spec, query, key, value, cursor, fields)
+
+    return fetch_condition(spec, query, key, cursor, fields=fields)
+
+
+def resolve_host(ip):
+    try:
+        return socket.gethostbyaddr(ip)[0]
+    except Exception:
+        return None
+
+
+def resolve_hosts(ips):
+    futures = {resolver.submit(resolve_host, ip): ip for ip in ips}
+    done, pending = wait(futures, timeout=app.config.get('PTR_TIMEOUT', 2))
+
+    # lookups still queued are dropped, running ones finish in the background
+    for future in pending:
+        future.cancel()
+
+    return {futures[future]: future.result() for future in done}
+
 
+def ip_entry(doc):
+    return {field: doc.get(field) for field in IP_FIELDS}
+
+
+def lookup_ips(ips):
+    indexed = {doc['ip']: doc for doc in find_addresses(mongo.db, ips, {'_id': 0})}
+
+    # importers index ips without a reverse lookup or geodata, those are completed here
+    known = {ip: ip_entry(doc) for ip, doc in indexed.items() if 'host' in doc}
+    unknown = [ip for ip in dict.fromkeys(ips) if ip not in known and ip_to_int(ip) is not None]
+
+    if unknown:
+        hosts = resolve_hosts(unknown)
+        counts = count_domains(mongo.db, [ip for ip in unknown if ip not in indexed])
+        networks = lookup_many(unknown)
+        geos = lookup_geodata_many(df, unknown)
+        now = datetime.utcnow()
+        posts = []
+        docs = []
+
+        for ip, network, geo in zip(unknown, networks, geos):
+            post = {'ip': ip, 'host': hosts.get(ip), 'updated': now, 'asn': network['asn'],
+                    'name': network['name'], 'prefix': network['prefix'], 'geo': geo}
+
+            # ips whose reverse lookup ran out of time are resolved again next time
+            if ip in hosts:
+                posts.append(post)
+
+                if ip not in indexed:
+                    docs.append({'ip': ip, 'host': post['host'], 'updated': now, 'asn': post['asn'],
+                                 'name': post['name'], 'cidr': [post['prefix']], 'geo': geo})
+
+            known[ip] = ip_entry(dict(indexed.get(ip, {'domains': counts.get(ip, 0)}), **post))
+
+        update_addresses(mongo.db, posts, counts)
+
+        # the whois and port tools keep enriching ips through the lookup collection
+        if docs:
             try:
-                query = {'distanceField': 'geo.distance',
-                    'near': {'type': 'Point',
-                    'coordinates': [float(splited[0]), float(splited[1])]},
-                    'maxDistance': 50000, 'spherical': True}
-                filter = {'_id': 0}
-                sort = {'updated': -1}
-                unwind = False
-                context = 'spatial'
-                limit = 30
-                reset = False
-
-                return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'loc-{}'.format(cache_key(sub_query)))
-            except ValueError:
-                return []
-        elif condition == 'banner':
-            sub_query = query.lower()
-
-            query = {'banner': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'banner-{}'.format(cache_key(sub_query)))
-        elif condition == 'asn':
-            sub_query = re.sub(r'[a-zA-Z:]', '', query.lower())
-
-            query = {'whois.asn': sub_query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'asn-{}'.format(cache_key(sub_query)))
-        elif condition == 'org':
-            sub_query = re.sub(r'[\(\)]', '', query.lower())
-            print(query)
-            query = {'$or': [{'whois.asn_description': query},
-                    {'ssl.subject.organization_name': query}]}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'org-{}'.format(cache_key(sub_query)))
-        elif condition == 'cidr':
-            sub_query = query.lower()
-
-            query = {'whois.asn_cidr': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'cidr-{}'.format(cache_key(sub_query)))
-        elif condition == 'cname':
-            sub_query = query.lower()
-
-            query = {'cname_record.target': {'$in': [sub_query]}}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'cname-{}'.format(cache_key(sub_query)))
-        elif condition == 'mx':
-            sub_query = query.lower()
-
-            query = {'mx_record.exchange': {'$in': [sub_query]}}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'mx-{}'.format(cache_key(sub_query)))
-        elif condition == 'ns':
-            sub_query = query.lower()
-
-            query = {'ns_record': {'$in': [sub_query]}}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'ns-{}'.format(cache_key(sub_query)))
-        elif condition == 'server':
-            sub_query = query.lower()
-
-            query = {'header.server': query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
-
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'server-{}'.format(cache_key(sub_query)))
-        elif condition == 'site':
-            sub_query = query.lower()
-
-            query = {'domain': sub_query}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            fetch = False
-            limit = 30
-
-            result = fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'site-{}'.format(cache_key(sub_query)))
-
-            if len(result) == 1:
-                required_keys = ['a_record', 'qrcode', 'geo']
-                optional_keys = ['ssl_scan_failed', 'header_scan_failed']
-
-                required = any([key not in result[0] for key in required_keys])
-                optional = any([key not in result[0] for key in optional_keys])
-
-                if (required and not optional) or required:
-                    fetch = True
-            elif len(result) == 0:
-                fetch = True
-
-            if fetch:
-                handle_query(sub_query, df)
-                return fetch_from_cache(query, filter, unwind, sort, limit, context, True, 'site-{}'.format(cache_key(sub_query)))
-            else:
-                return result
-        elif condition == 'ipv4':
-            sub_query = query.lower()
+                mongo.db.lookup.insert_many(docs, ordered=False)
+            except BulkWriteError:
+                pass
+
+    return [known.get(ip) for ip in ips]
+
+
+def lookup_sites(domains):
+    domains = [domain.lower() for domain in domains]
+    valid = [domain for domain in dict.fromkeys(domains) if DOMAIN_PATTERN.match(domain)]
+    known = {doc['domain']: doc for doc in mongo.db.dns.find({'domain': {'$in': valid}}, DOCUMENT_FILTER)}
+
+    enqueue_many(cache, [domain for domain in valid if domain not in known])
+
+    return attach_certificates([known.get(domain) for domain in domains])
+
+
+def bulk_items():
+    data = request.get_json(silent=True)
+
+    if isinstance(data, dict):
+        data = data.get('items')
+
+    if not isinstance(data, list) or not all(isinstance(item, str) for item in data):
+        raise BadRequest('expected a list of strings')
+
+    if len(data) > app.config.get('BULK_MAX_ITEMS', 10000):
+        raise RequestEntityTooLarge('too many items')
 
-            query = {'a_record': {'$in': [query]}}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
+    return [item.strip() for item in data]
 
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'ipv4-{}'.format(cache_key(sub_query)))
-        elif condition == 'ipv6':
-            sub_query = query.lower()
 
-            query = {'aaaa_record': {'$in': [query]}}
-            filter = {'_id': 0}
-            sort = {'updated': -1}
-            context = 'normal'
-            unwind = False
-            reset = False
-            limit = 30
+def fetch_all_prefix(prefix, mode='within'):
+    network = parse_network(prefix)
 
-            return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'ipv6-{}'.format(cache_key(sub_query)))
+    if network is None or mode not in PREFIX_MODES:
+        raise BadRequest('invalid prefix')
 
+    limit = app.config.get('SUBNET_LIMIT', 200)
+    known = {}
 
-def fetch_all_prefix(prefix):
-    return mongo.db.lookup.find({'cidr': {'$in': [prefix]}}, {'_id': 0})
+    for query in prefix_queries(network, mode):
+        for doc in mongo.db.prefixes.find(query, {'_id': 0}).sort([('start', ASCENDING), ('end', ASCENDING)]).limit(limit):
+            known.setdefault(doc['cidr'], doc)
+
+    items = sorted(known.values(), key=lambda doc: (doc['start'], doc['end']))
+    query = address_query(network, mode)
+
+    if query is not None:
+        items += mongo.db.ips.find(query, {'_id': 0}).sort([('_id', ASCENDING)]).limit(limit)
+
+    return items
 
 
 def fetch_all_asn(asn):
     return mongo.db.lookup.find({'whois.asn': asn}, {'_id': 0}).limit(5)
 
 
-def fetch_query_domain(q):
+def fetch_query_domain(q, cursor=None, fields=None):
     sub_query = q.lower()
 
     query = {'$text': {'$search': q}}
-    filter = {'_id': 0}
-    sort = {'score': {'$meta': 'textScore'}}
+    filter = field_filter(fields)
+    sort = {'score': -1}
     context = 'text'
     unwind = False
     reset = False
     limit = 30
 
-    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'all-{}'.format(cache_key(sub_query)))
+    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, projection_key('all-{}'.format(cache_key(sub_query)), fields), cursor=cursor)
 
 
-def fetch_latest_dns():
+def fetch_latest_dns(refresh=False, cursor=None):
     date = datetime.utcnow() - timedelta(days=5)
 
     query = {'updated': {'$gte': date}}
-    filter = {'_id': 0}
+    filter = DOCUMENT_FILTER
     sort = {'updated': -1}
     context = 'normal'
     unwind = False
     reset = False
     limit = 200
 
-    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'latest_dns')
+    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'latest_dns', refresh, cursor=cursor)
 
 
-def fetch_latest_cidr():
+def fetch_latest_cidr(refresh=False, cursor=None):
     query = {'whois.asn_cidr': {'$exists': True}}
     filter = {'_id': 0, 'whois.asn_country_code': 1, 'whois.asn_cidr': 1}
     sort = {'updated': -1}
@@ -597,10 +1010,10 @@ def fetch_latest_cidr():
     reset = False
     limit = 200
 
-    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'latest_cidr')
+    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'latest_cidr', refresh, cursor=cursor)
 
 
-def fetch_latest_ipv4():
+def fetch_latest_ipv4(refresh=False, cursor=None):
     query = {'a_record.0': {'$exists': True}}
     filter = {'_id': 0, 'a_record': '$a_record', 'country_code': '$geo.country_code'}
     sort = {'updated': -1}
@@ -609,10 +1022,10 @@ def fetch_latest_ipv4():
     reset = False
     limit = 200
 
-    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'latest_ipv4')
+    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'latest_ipv4', refresh, cursor=cursor)
 
 
-def fetch_latest_asn():
+def fetch_latest_asn(refresh=False, cursor=None):
     query = {'whois.asn': {'$exists': True}}
     filter = {'_id': 0, 'whois.asn': 1, 'whois.asn_country_code': 1}
     sort = {'updated': -1}
@@ -621,31 +1034,31 @@ def fetch_latest_asn():
     reset = False
     limit = 200
 
-    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'latest_asn')
+    return fetch_from_cache(query, filter, unwind, sort, limit, context, reset, 'latest_asn', refresh, cursor=cursor)
 
 
-def asn_lookup(ipv4):
-    asndb = pyasn.pyasn('rib.20191127.2000.dat',
-                        as_names_file='asn_names.json')
-    asn, prefix = asndb.lookup(ipv4)
-    name = asndb.get_as_name(asn)
+def paginated(items, next_cursor):
+    if items:
+        response = jsonify(items)
 
-    return {'prefix': prefix, 'name': name, 'asn': asn}
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+
+        return response
+    else:
+        return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
 
 
 @app.route('/query/<string:domain>', methods=['GET'])
 def fetch_data_domain(domain):
-    items = list(fetch_query_domain(domain))
+    items, next_cursor = fetch_query_domain(domain, request.args.get('cursor'), parse_fields(request.args.get('fields')))
 
-    if items:
-        return jsonify(items)
-    else:
-        return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
+    return paginated(items, next_cursor)
 
 
 @app.route('/subnet/<string:sub>/<string:prefix>', methods=['GET'])
 def fetch_data_prefix(sub, prefix):
-    items = list(fetch_all_prefix('{}/{}'.format(sub, prefix)))
+    items = fetch_all_prefix('{}/{}'.format(sub, prefix), request.args.get('mode', 'within'))
 
     if items:
         return jsonify(items)
@@ -655,61 +1068,40 @@ def fetch_data_prefix(sub, prefix):
 
 @app.route('/match/<path:query>', methods=['GET'])
 def fetch_data_condition(query):
-    ql = query.split(':')
-    f = ql[0].lower()
-
-    if f in ['ipv6', 'ca', 'crl', 'org', 'ocsp', 'before', 'after']:
-        q = ':'.join(ql[1:])
-    else:
-        q = ql[1]
+    condition, value = parse_condition(query)
+    items, next_cursor = fetch_match_condition(condition, value, request.args.get('cursor'),
+                                               parse_fields(request.args.get('fields')))
 
-    items = list(fetch_match_condition(f, q))
-
-    if items:
-        return jsonify(items)
-    else:
-        return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
+    return paginated(items, next_cursor)
 
 
 @app.route('/dns/', methods=['GET'])
 @app.route('/dns', methods=['GET'])
 def fetch_latest_dns_data():
-    items = fetch_latest_dns()
+    items, next_cursor = fetch_latest_dns(cursor=request.args.get('cursor'))
 
-    if items:
-        return jsonify(items)
-    else:
-        return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
+    return paginated(items, next_cursor)
 
 
 @app.route('/asn', methods=['GET'])
 def fetch_latest_asn_data():
-    items = fetch_latest_asn()
+    items, next_cursor = fetch_latest_asn(cursor=request.args.get('cursor'))
 
-    if items:
-        return jsonify(items)
-    else:
-        return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
+    return paginated(items, next_cursor)
 
 
 @app.route('/cidr', methods=['GET'])
 def fetch_latest_cidr_data():
-    items = fetch_latest_cidr()
+    items, next_cursor = fetch_latest_cidr(cursor=request.args.get('cursor'))
 
-    if items:
-        return jsonify(items)
-    else:
-        return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
+    return paginated(items, next_cursor)
 
 
 @app.route('/ipv4', methods=['GET'])
 def fetch_latest_ipv4_data():
-    items = list(fetch_latest_ipv4())
+    items, next_cursor = fetch_latest_ipv4(cursor=request.args.get('cursor'))
 
-    if items:
-        return jsonify(items)
-    else:
-        return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
+    return paginated(items, next_cursor)
 
 
 @app.route('/graph/<string:site>', methods=['GET'])
@@ -722,6 +1114,42 @@ def fetch_graph(site):
         return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
 
 
+def qrcode_etag(domain):
+    return hashlib.sha1(u'qrcode-v1-{}'.format(domain).encode('utf-8')).hexdigest()
+
+
+def fetch_qrcode(domain):
+    key = 'qrcode-{}'.format(cache_key(domain))
+    image = cache.get(key)
+
+    if image is None:
+        image = qrcode_png(domain)
+        cache.set(key, image, ex=app.config.get('CACHE_EXPIRE', 3600 * 24))
+
+    return image
+
+
+@app.route('/qrcode/<string:domain>', methods=['GET'])
+def fetch_qrcode_image(domain):
+    domain = domain.lower()
+
+    if not DOMAIN_PATTERN.match(domain):
+        raise BadRequest('invalid domain')
+
+    etag = qrcode_etag(domain)
+
+    if request.if_none_match.contains_weak(etag):
+        res = make_response('', status.HTTP_304_NOT_MODIFIED)
+    else:
+        res = make_response(fetch_qrcode(domain))
+        res.headers['Content-Type'] = 'image/png'
+
+    res.set_etag(etag)
+    res.headers['Cache-Control'] = 'public, max-age={}'.format(app.config.get('QRCODE_MAX_AGE', 3600 * 24))
+
+    return res
+
+
 @app.route('/', methods=['GET'])
 def fetch_nothing():
     return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
@@ -729,33 +1157,20 @@ def fetch_nothing():
 
 @app.route('/ip/<string:ipv4>', methods=['GET'])
 def fetch_data_ipv4(ipv4):
-    items = list(fetch_one_ip(ipv4))
+    if ip_to_int(ipv4) is None:
+        raise BadRequest('invalid ip')
 
-    if len(items) == 0:
-        res = asn_lookup(ipv4)
+    return jsonify(lookup_ips([ipv4]))
 
-        try:
-            host = socket.gethostbyaddr(ipv4)[0]
-        except Exception:
-            host = None
 
-        prop = {'ip': ipv4, 'host': host, 'updated': datetime.utcnow(),
-                'asn': res['asn'], 'name': res['name'], 'cidr': [res['prefix']]}
+@app.route('/bulk/ip', methods=['POST'])
+def fetch_bulk_ip():
+    return jsonify(lookup_ips(bulk_items()))
 
-        try:
-            mongo.db.lookup.insert_one(prop)
-        except DuplicateKeyError:
-            pass
 
-        if '_id' in prop:
-            del prop['_id']
-
-        items = [prop]
-
-    if items:
-        return jsonify(items)
-    else:
-        return jsonify({'status': 404, 'message': 'no documents found'}), status.HTTP_404_NOT_FOUND
+@app.route('/bulk/site', methods=['POST'])
+def fetch_bulk_site():
+    return jsonify(lookup_sites(bulk_items()))
 
 
 def argparser():
@@ -770,50 +1185,38 @@ def argparser():
 # init app
 cache = connect_cache()
 df = read_dataframe('data/geodata.csv')
+revalidator = ThreadPoolExecutor(max_workers=app.config.get('CACHE_REVALIDATE_THREADS', 4))
+resolver = ThreadPoolExecutor(max_workers=app.config.get('BULK_RESOLVER_THREADS', 32))
+revalidating = set()
+revalidating_lock = threading.Lock()
 
 
 # create index for all match methods
-create_index('header.x-powered-by', 'updated')
-create_index('banner', 'updated')
-create_index('ports.port', 'updated')
-
-# create index for whois section
-create_index('whois.asn', 'updated')
-create_index('whois.asn_description', 'updated')
-create_index('whois.asn_country_code', 'updated')
-create_index('whois.asn_registry', 'updated')
-create_index('whois.asn_cidr', 'updated')
-
-# create index for records section
-create_index('cname_record.target', 'updated')
-create_index('mx_record.exchange', 'updated')
-create_index('header.server', 'updated')
-create_index('header.status', 'updated')
-create_index('ns_record', 'updated')
-create_index('aaaa_record', 'updated')
-create_index('a_record', 'updated')
-create_index('domain', 'updated')
-
-# create index for geo section
-create_index('geo.loc.coordinates', 'updated')
-create_index('geo.country_code', 'updated')
-create_index('geo.country', 'updated')
-create_index('geo.state', 'updated')
-create_index('geo.city', 'updated')
-create_index('ssl.ocsp', 'updated')
-
-# create index for ssl section
-create_index('ssl.not_after', 'updated')
-create_index('ssl.not_before', 'updated')
-create_index('ssl.ca_issuers', 'updated')
-create_index('ssl.issuer.common_name', 'updated')
-create_index('ssl.issuer.organization_name', 'updated')
-create_index('ssl.issuer.organizational_unit_name', 'updated')
-create_index('ssl.subject_alt_names', 'updated')
-create_index('ssl.subject.common_name', 'updated')
-create_index('ssl.subject.organizational_unit_name', 'updated')
-create_index('ssl.subject.organization_name', 'updated')
-create_index('ssl.crl_distribution_points', 'updated')
+indexes = mongo.db.dns.index_information()
+
+migrated = certificates_migrated(mongo.db)
+
+for spec in MATCH_CONDITIONS.values():
+    if spec['index']:
+        for field in spec['fields']:
+            if not certificate_field(field):
+                create_index(field, 'updated', indexes)
+                continue
+
+            mongo.db.certificates.create_index(
+                [(field[len('ssl.'):], DESCENDING), ('updated', DESCENDING)], background=True)
+
+            # embedded ssl fields are matched on dns until the migration has finished
+            if migrated:
+                drop_index(field, 'updated', indexes)
+            else:
+                create_index(field, 'updated', indexes)
+
+create_index('certificate', 'updated', indexes)
+create_index('geo.country', 'updated', indexes)
+mongo.db.certificates.create_index([('updated', DESCENDING)], background=True)
+mongo.db.prefixes.create_index([('start', ASCENDING), ('end', ASCENDING)], background=True)
+mongo.db.dns.create_index([('updated', DESCENDING), ('_id', DESCENDING)], background=True)
 
 
 if __name__ == '__main__':
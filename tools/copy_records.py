@@ -2,46 +2,45 @@
 
 import re
 import time
-import multiprocessing
 import argparse
 
-from pymongo import MongoClient
 from pymongo.errors import DuplicateKeyError
 
+from utils.connection import connect, configure
+from utils.partition import Checkpoint, run_workers
 from utils.extract_geodata import read_dataframe
 from utils.update_entry import handle_query
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
-def retrieve_mx_records(db, skip, limit):
-    return db.dns.find({'mx_record.exchange': {'$exists': True},
-                        'mx_scan_failed': {'$exists': False}},
-                       {'_id': 0, 'mx_record.exchange': 1})[limit - skip:limit]
+def retrieve_mx_records(db, checkpoint):
+    return checkpoint.find(db.dns, {'mx_record.exchange': {'$exists': True},
+                                    'mx_scan_failed': {'$exists': False}},
+                           {'mx_record.exchange': 1})
 
 
 def retrieve_domain(db, domain):
     return db.dns.find_one({'domain': domain})
 
 
-def worker(df, host, skip, limit):
+def worker(df, host, spec):
+    configure(host)
     client = connect(host)
     db = client.ip_data
+    checkpoint = Checkpoint(client, spec)
     mx_records_uniq = set()
 
-    mx_records = retrieve_mx_records(db, limit, skip)
-
-    for mx_record in mx_records:
+    for mx_record in retrieve_mx_records(db, checkpoint):
         for mx in mx_record['mx_record']:
+            if mx['exchange'] in mx_records_uniq:
+                continue
+
             mx_records_uniq.add(mx['exchange'])
+            data = retrieve_domain(db, mx['exchange'])
 
-    for mx_record in mx_records_uniq:
-        data = retrieve_domain(db, mx_record)
+            if not data:
+                handle_query(mx['exchange'], df, 'mx_record.exchange', 'mx_scan_failed')
 
-        if not data:
-            handle_query(mx_record, df, 'mx_record.exchange', 'mx_scan_failed')
+    checkpoint.finish()
 
 
 def argparser():
@@ -59,20 +58,5 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db.dns.estimated_document_count() / (threads + 5000))
-    limit = amount
-    print(limit, amount)
-
-    for f in range(threads):
-        j = multiprocessing.Process(
-            target=worker, args=(df, args.host, limit, amount))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        client.close()
-        j.join()
-        print('exitcode = {}'.format(j.exitcode))
+    run_workers('copy_records', worker, db.dns, args.worker, df, args.host)
+    client.close()
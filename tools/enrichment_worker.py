@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import argparse
+
+from redis import Redis
+
+from utils.connection import configure
+from utils.extract_geodata import read_dataframe
+from utils.update_entry import handle_query
+from utils.enrichment_queue import dequeue, complete
+
+
+def connect_cache(host):
+    return Redis(host=host, port=6379)
+
+
+def worker(host, redis_host, df):
+    configure(host)
+    cache = connect_cache(redis_host)
+
+    while True:
+        domain = dequeue(cache)
+
+        if domain is None:
+            continue
+
+        try:
+            handle_query(domain, df)
+            print('INFO: enriched domain {}'.format(domain))
+        except Exception as e:
+            print('ERROR: could not enrich domain {}, {}'.format(domain, e))
+        finally:
+            complete(cache, domain)
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--worker', help='set worker count', type=int, required=True)
+    parser.add_argument('--input', help='set the geodata input file', type=str, default='data/geodata.csv')
+    parser.add_argument('--host', help='set the mongodb host or uri', type=str, default='localhost')
+    parser.add_argument('--redis', help='set the redis host', type=str, default='127.0.0.1')
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = argparser()
+    df = read_dataframe(args.input)
+
+    jobs = []
+
+    for f in range(args.worker):
+        j = multiprocessing.Process(target=worker, args=(args.host, args.redis, df))
+        jobs.append(j)
+        j.start()
+
+    for j in jobs:
+        j.join()
+        print('exitcode = {}'.format(j.exitcode))
@@ -1,46 +1,190 @@
 #!/usr/bin/env python3
 
 import os
+import glob
+import json
+import time
 import pyasn
-import multiprocessing
+import threading
 import argparse
 
 from datetime import datetime
-from pymongo import MongoClient
+try:
+    from .connection import connect
+    from .partition import Checkpoint, run_workers
+    from .prefix_table import TABLE_PATH, load_table, table_version
+except ImportError:
+    from connection import connect
+    from partition import Checkpoint, run_workers
+    from prefix_table import TABLE_PATH, load_table, table_version
 
 
 AS_NAMES_FILE_PATH = os.path.join(os.path.dirname(__file__), 'asn_names.json')
+RIB_FILE_PATH = 'rib.20191127.2000.dat'
+RIB_FILE_PATTERN = 'rib.*.dat'
+PREFIX_TABLE_PATH = os.environ.get('PREFIX_TABLE_PATH', TABLE_PATH)
+RELOAD_INTERVAL = 300
+BATCH_SIZE = 1000
+
+
+class ASNDatabase:
+    def __init__(self, pattern=RIB_FILE_PATTERN, as_names_file=AS_NAMES_FILE_PATH, interval=RELOAD_INTERVAL,
+                 table_path=PREFIX_TABLE_PATH):
+        self.pattern = pattern
+        self.as_names_file = as_names_file
+        self.interval = interval
+        self.table_path = table_path
+        self.lock = threading.Lock()
+        self.asndb = None
+        self.path = None
+        self.checked = 0
+        self.reloading = False
+        self.table = None
+        self.version = None
+        self.table_checked = float('-inf')
+        self.names = None
+
+    def latest(self):
+        files = sorted(glob.glob(self.pattern))
 
+        if files:
+            return files[-1]
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
+        return RIB_FILE_PATH
 
+    def load(self, path):
+        return pyasn.pyasn(path, as_names_file=self.as_names_file)
 
-def retrieve_ips(db, limit, skip):
-    return db.lookup.find({'name': {'$exists': False}}).sort([('_id', -1)])[limit - skip:limit]
+    def database(self):
+        if self.asndb is None:
+            with self.lock:
+                if self.asndb is None:
+                    self.path = self.latest()
+                    self.asndb = self.load(self.path)
+                    self.checked = time.monotonic()
+        elif time.monotonic() - self.checked > self.interval:
+            self.check()
+
+        return self.asndb
+
+    def check(self):
+        if not self.lock.acquire(blocking=False):
+            return
+
+        try:
+            self.checked = time.monotonic()
+            path = self.latest()
+
+            if path != self.path and not self.reloading:
+                self.reloading = True
+                threading.Thread(target=self.reload, args=(path,), daemon=True).start()
+        finally:
+            self.lock.release()
+
+    def reload(self, path):
+        try:
+            asndb = self.load(path)
+            self.asndb, self.path = asndb, path
+            print('INFO: reloaded asn database from {}'.format(path))
+        except Exception as e:
+            print('ERROR: could not reload asn database from {}, {}'.format(path, e))
+        finally:
+            self.reloading = False
+
+    def prefix_table(self):
+        # the table is memory mapped, so every process shares the same pages
+        if time.monotonic() - self.table_checked > self.interval:
+            self.table_checked = time.monotonic()
+            version = table_version(self.table_path)
+
+            if version != self.version:
+                self.table, self.version = load_table(self.table_path), version
+
+        return self.table
+
+    def as_name(self, asn):
+        if self.names is None:
+            try:
+                with open(self.as_names_file) as f:
+                    self.names = json.load(f)
+            except (IOError, ValueError):
+                self.names = {}
+
+        return self.names.get(str(asn)) if asn else None
+
+    def lookup(self, ipv4):
+        table = self.prefix_table()
+
+        if table is not None:
+            return self.lookup_many([ipv4])[0]
+
+        asndb = self.database()
+        asn, prefix = asndb.lookup(ipv4)
+
+        return {'prefix': prefix, 'name': asndb.get_as_name(asn), 'asn': asn}
+
+    def lookup_many(self, ips):
+        table = self.prefix_table()
+
+        if table is not None:
+            return [dict(res, name=self.as_name(res['asn'])) for res in table.lookup_many(ips)]
+
+        asndb = self.database()
+        results = []
+
+        for ip in ips:
+            try:
+                asn, prefix = asndb.lookup(ip)
+            except ValueError:
+                asn, prefix = None, None
+
+            results.append({'prefix': prefix, 'name': asndb.get_as_name(asn) if asn else None, 'asn': asn})
+
+        return results
+
+
+asndb = ASNDatabase()
+
+
+def retrieve_ips(db, checkpoint):
+    return checkpoint.find(db.lookup, {'name': {'$exists': False}})
 
 
 def asn_lookup(ipv4):
-    asndb = pyasn.pyasn('rib.20191127.2000.dat', as_names_file=AS_NAMES_FILE_PATH)
-    asn, prefix = asndb.lookup(ipv4)
-    name = asndb.get_as_name(asn)
+    return asndb.lookup(ipv4)
+
 
-    return {'name': name}
+def lookup_many(ips):
+    return asndb.lookup_many(ips)
 
 
-def worker(host, skip, limit):
+def update_names(db, ips):
+    for ip, res in zip(ips, lookup_many(ips)):
+        db.lookup.update_one({'ip': ip}, {'$set': {
+                             'updated': datetime.utcnow(),
+                             'name': res['name']}}, upsert=False)
+
+        print('INFO: updated document with ip {} and added asn name {}'.format(ip, res['name']))
+
+
+def worker(host, spec):
     client = connect(host)
     db = client.ip_data
+    checkpoint = Checkpoint(client, spec, auto=False)
+    ips = []
 
-    for i in retrieve_ips(db, skip, limit):
-        res = asn_lookup(i['ip'])
+    for i in retrieve_ips(db, checkpoint):
+        ips.append(i['ip'])
 
-        db.lookup.update_one({'ip': i['ip']}, {'$set': {
-                             'updated': datetime.utcnow(),
-                             'name': res['name']}}, upsert=False)
+        if len(ips) >= BATCH_SIZE:
+            update_names(db, ips)
+            checkpoint.save()
+            ips = []
 
-        print('INFO: updated document with ip {} and added asn name {}'.format(i['ip'], res['name']))
+    if ips:
+        update_names(db, ips)
 
+    checkpoint.finish()
     client.close()
     return
 
@@ -59,18 +203,5 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db.lookup.estimated_document_count() / (threads + 50000))
-    limit = amount
-
-    for f in range(threads):
-        j = multiprocessing.Process(target=worker, args=(args.host, limit, amount))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        j.join()
-        client.close()
-        print('exitcode = {}'.format(j.exitcode))
+    run_workers('asn_lookup', worker, db.lookup, args.worker, args.host)
+    client.close()
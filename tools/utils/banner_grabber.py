@@ -1,19 +1,19 @@
 #!/usr/bin/env python3
 
 import socket
-import multiprocessing
 import argparse
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+    from .partition import Checkpoint, run_workers
+except ImportError:
+    from connection import connect
+    from partition import Checkpoint, run_workers
 from pymongo.errors import DuplicateKeyError
 
 from datetime import datetime
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def update_data(db, doc_id, domain, ip, post):
     try:
         db.dns.update_one({'_id': doc_id}, {'$set': post}, upsert=False)
@@ -22,12 +22,11 @@ def update_data(db, doc_id, domain, ip, post):
         pass
 
 
-def retrieve_documents(db, skip, limit):
-    return db.dns.find({'a_record': {'$exists': True},
-                        'banner': {'$exists': False},
-                        'ports.port': {'$in': [22]},
-                        'banner_scan_failed': {'$exists': False}}).sort(
-                        [('updated', -1)])[limit - skip:limit]
+def retrieve_documents(db, checkpoint):
+    return checkpoint.find(db.dns, {'a_record': {'$exists': True},
+                                    'banner': {'$exists': False},
+                                    'ports.port': {'$in': [22]},
+                                    'banner_scan_failed': {'$exists': False}})
 
 
 def grab_banner(ip, port):
@@ -42,11 +41,12 @@ def grab_banner(ip, port):
         return ''
 
 
-def worker(host, skip, limit):
+def worker(host, spec):
     client = connect(host)
     db = client.ip_data
+    checkpoint = Checkpoint(client, spec)
 
-    for document in retrieve_documents(db, limit, skip):
+    for document in retrieve_documents(db, checkpoint):
         banner = grab_banner(document['a_record'][0], 22)
 
         if banner:
@@ -56,7 +56,9 @@ def worker(host, skip, limit):
         else:
             update_data(db, document['_id'], document['domain'], document['a_record'][0],
                         {'banner_scan_failed': datetime.utcnow()})
+            checkpoint.error('banner_scan_failed')
 
+    checkpoint.finish()
     client.close()
     return
 
@@ -75,21 +77,8 @@ def main():
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = 16
-    amount = db.dns.estimated_document_count() / threads
-    limit = amount
-
-    for f in range(threads):
-        j = multiprocessing.Process(target=worker, args=(args.host, limit, amount))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        j.join()
-        client.close()
-        print('exitcode = {}'.format(j.exitcode))
+    run_workers('banner_grabber', worker, db.dns, args.worker, args.host)
+    client.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import os
+
+from pymongo import MongoClient
+
+
+MONGO_URI = os.environ.get('MONGO_URI')
+MONGO_HOST = os.environ.get('MONGO_HOST', 'localhost')
+MONGO_POOL_SIZE = int(os.environ.get('MONGO_POOL_SIZE', 100))
+
+clients = {}
+settings = {'uri': None, 'pid': None}
+
+
+def mongo_uri(host=None):
+    if host is None:
+        return settings['uri'] or MONGO_URI or 'mongodb://{}:27017'.format(MONGO_HOST)
+
+    if '://' in host:
+        return host
+
+    return 'mongodb://{}:27017'.format(host)
+
+
+def configure(host):
+    settings['uri'] = mongo_uri(host) if host else None
+
+
+def connect(host=None):
+    if settings['pid'] != os.getpid():
+        clients.clear()
+        settings['pid'] = os.getpid()
+
+    uri = mongo_uri(host)
+
+    if uri not in clients:
+        clients[uri] = MongoClient(uri, connect=False, maxPoolSize=MONGO_POOL_SIZE)
+
+    return clients[uri]
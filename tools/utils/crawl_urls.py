@@ -4,7 +4,6 @@
 import re
 import time
 import requests
-import multiprocessing
 import argparse
 
 from lxml import html
@@ -23,7 +22,12 @@ from requests.exceptions import ChunkedEncodingError
 from requests.exceptions import ContentDecodingError
 from requests.exceptions import TooManyRedirects
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+    from .partition import Checkpoint, run_workers
+except ImportError:
+    from connection import connect
+    from partition import Checkpoint, run_workers
 from pymongo.errors import DuplicateKeyError
 from pymongo.errors import AutoReconnect
 from pymongo.errors import WriteError
@@ -36,12 +40,8 @@ def check_mail(url):
     return re.match(r'\b[\w.+-]+?@[-_\w]+[.]+[-_.\w]+\b', url)
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
-def retrieve_domains(db_ip_data, skip, limit):
-    return db_ip_data.dns.find({'domain_crawled': {'$exists': False}})[limit - skip:limit]
+def retrieve_domains(db_ip_data, checkpoint):
+    return checkpoint.find(db_ip_data.dns, {'domain_crawled': {'$exists': False}})
 
 
 def update_data(db_ip_data, domain):
@@ -108,26 +108,24 @@ def get_urls(db, ua, url):
     return url_set
 
 
-def worker(host, skip, limit):
+def worker(host, spec):
     client = connect(host)
     db_url_data = client.url_data
     db_ip_data = client.ip_data
+    checkpoint = Checkpoint(client, spec)
     ua = UserAgent()
 
-    try:
-        domains = retrieve_domains(db_ip_data, limit, skip)
-    except CursorNotFound:
-        client.close()
-        return
-
-    for domain in domains:
+    for domain in retrieve_domains(db_ip_data, checkpoint):
         print(u'INFO: the domain {} is beeing processed'.format(domain['domain']))
-        links = get_urls(db, ua, domain['domain'])
+        links = get_urls(db_ip_data, ua, domain['domain'])
 
         if links is not None and len(links) > 0:
             for link in links:
                 add_urls(db_url_data, db_ip_data, link, domain['domain'])
+        else:
+            checkpoint.error('no_links')
 
+    checkpoint.finish()
     client.close()
     return
 
@@ -146,19 +144,5 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db.dns.estimated_document_count() / (threads + 50000))
-    limit = amount
-    print(limit, amount)
-
-    for f in range(threads):
-        j = multiprocessing.Process(target=worker, args=(args.host, limit, amount))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        client.close()
-        j.join()
-        print('exitcode = {}'.format(j.exitcode))
+    run_workers('crawl_urls', worker, db.dns, args.worker, args.host)
+    client.close()
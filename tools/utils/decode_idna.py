@@ -3,7 +3,10 @@
 import idna
 import argparse
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
 from pymongo.errors import DuplicateKeyError
 from pymongo.errors import CursorNotFound
 
@@ -11,10 +14,6 @@ from idna.core import IDNAError
 from datetime import datetime
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def retrieve_domains(db):
     return db.dns.find({'domain': {'$regex': '([\w\-]*\.)?(xn--)+[\w]*'}})
 
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import struct
+import random
+import asyncio
+
+import dns.name
+import dns.message
+import dns.rdatatype
+import dns.rcode
+import dns.exception
+
+from dns import resolver
+
+
+RECORD_TYPES = ['A', 'NS', 'MX', 'SOA', 'AAAA', 'CNAME']
+
+WINDOW = 1000
+TIMEOUT = 1
+RETRIES = 2
+RATE = 10000
+CHUNK_SIZE = 5000
+
+
+def default_nameservers():
+    nameservers = os.environ.get('DNS_NAMESERVERS')
+
+    if nameservers:
+        return nameservers.split(',')
+
+    return resolver.Resolver().nameservers
+
+
+def expire(future):
+    if not future.done():
+        future.set_exception(asyncio.TimeoutError())
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NameserverProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.pending = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+
+        id = struct.unpack('>H', data[:2])[0]
+        entry = self.pending.get(id)
+
+        # a reply that only guesses the id is dropped, the query keeps waiting for the real one
+        if entry is None or not matches_question(data, entry[1]):
+            return
+
+        future, _ = self.pending.pop(id)
+
+        if not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        return
+
+    def connection_lost(self, exc):
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('nameserver socket closed'))
+
+        self.pending.clear()
+
+
+class Nameserver:
+    def __init__(self, address, port, rate):
+        self.address = address
+        self.port = port
+        self.limiter = RateLimiter(rate)
+        self.protocol = None
+
+    async def open(self, loop):
+        _, self.protocol = await loop.create_datagram_endpoint(
+            NameserverProtocol, remote_addr=(self.address, self.port))
+
+    def close(self):
+        if self.protocol is not None and self.protocol.transport is not None:
+            self.protocol.transport.close()
+
+    def query_id(self):
+        while True:
+            id = random.randint(0, 65535)
+
+            if id not in self.protocol.pending:
+                return id
+
+    async def query(self, loop, qname, rdtype, timeout):
+        await self.limiter.acquire()
+
+        id = self.query_id()
+        future = loop.create_future()
+        self.protocol.pending[id] = (future, encode_question(qname, rdtype))
+        self.protocol.transport.sendto(encode_query(id, qname, rdtype))
+        timer = loop.call_later(timeout, expire, future)
+
+        try:
+            return await future
+        finally:
+            timer.cancel()
+            self.protocol.pending.pop(id, None)
+
+    async def exchange_tcp(self, id, qname, rdtype):
+        query = encode_query(id, qname, rdtype)
+        reader, writer = await asyncio.open_connection(self.address, self.port)
+
+        try:
+            writer.write(struct.pack('>H', len(query)) + query)
+            length = struct.unpack('>H', await reader.readexactly(2))[0]
+            data = await reader.readexactly(length)
+        finally:
+            writer.close()
+
+        if len(data) < 12 or struct.unpack('>H', data[:2])[0] != id or not matches_question(data, encode_question(qname, rdtype)):
+            raise ConnectionError('mismatched tcp reply')
+
+        return data
+
+    async def query_tcp(self, qname, rdtype, timeout):
+        await self.limiter.acquire()
+
+        return await asyncio.wait_for(self.exchange_tcp(random.randint(0, 65535), qname, rdtype), timeout)
+
+
+class AsyncResolver:
+    def __init__(self, nameservers=None, port=53, window=WINDOW, timeout=TIMEOUT, retries=RETRIES, rate=RATE):
+        self.addresses = nameservers or default_nameservers()
+        self.port = port
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.rate = rate
+        self.nameservers = []
+        self.semaphore = None
+        self.loop = None
+
+    async def open(self):
+        self.loop = asyncio.get_event_loop()
+        self.semaphore = asyncio.Semaphore(self.window)
+        self.nameservers = [Nameserver(address, self.port, self.rate) for address in self.addresses]
+
+        for nameserver in self.nameservers:
+            await nameserver.open(self.loop)
+
+    def close(self):
+        for nameserver in self.nameservers:
+            nameserver.close()
+
+    async def query(self, qname, record):
+        rdtype = dns.rdatatype.from_text(record)
+        offset = random.randrange(len(self.nameservers))
+
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                nameserver = self.nameservers[(offset + attempt) % len(self.nameservers)]
+
+                try:
+                    data = await nameserver.query(self.loop, qname, rdtype, self.timeout)
+
+                    # truncated answers are asked again over tcp
+                    if data[2] & 0x02:
+                        data = await nameserver.query_tcp(qname, rdtype, self.timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+                    continue
+
+                rcode = data[3] & 0x0F
+
+                if rcode in (dns.rcode.SERVFAIL, dns.rcode.REFUSED):
+                    continue
+
+                # skip the full parse for negative and empty answers
+                if rcode != dns.rcode.NOERROR or struct.unpack('>H', data[6:8])[0] == 0:
+                    return
+
+                try:
+                    return format_records(dns.message.from_wire(data), record)
+                except dns.exception.DNSException:
+                    return
+
+    async def resolve(self, domain, records=RECORD_TYPES):
+        qname = encode_name(domain)
+
+        if qname is None:
+            return domain, dict.fromkeys(records)
+
+        answers = await asyncio.gather(*[self.query(qname, record) for record in records])
+
+        return domain, dict(zip(records, answers))
+
+    async def resolve_all(self, domains, records=RECORD_TYPES):
+        return await asyncio.gather(*[self.resolve(domain, records) for domain in domains])
+
+
+def encode_name(domain):
+    try:
+        return bytes(dns.name.from_text(domain).to_wire())
+    except (dns.exception.DNSException, UnicodeError, ValueError):
+        return
+
+
+def encode_question(qname, rdtype):
+    return qname + struct.pack('>HH', rdtype, 1)
+
+
+def encode_query(id, qname, rdtype):
+    return struct.pack('>HHHHHH', id, 0x0100, 1, 0, 0, 0) + encode_question(qname, rdtype)
+
+
+def matches_question(data, question):
+    end = 12 + len(question)
+
+    if len(data) < end or struct.unpack('>H', data[4:6])[0] != 1:
+        return False
+
+    # names compare case insensitive, type and class bytes exactly
+    return data[12:end - 4].lower() == question[:-4].lower() and data[end - 4:end] == question[-4:]
+
+
+def format_records(response, record):
+    records = []
+    rdtype = dns.rdatatype.from_text(record)
+
+    for rrset in response.answer:
+        if rrset.rdtype != rdtype:
+            continue
+
+        for item in rrset:
+            if record not in ['MX', 'NS', 'SOA', 'CNAME']:
+                records.append(item.address)
+            elif record == 'NS':
+                records.append(item.target.to_unicode().strip('.').lower())
+            elif record == 'SOA':
+                if len(records) > 0:
+                    records[0] = item.to_text().replace('\\', '').lower()
+                else:
+                    records.append(item.to_text().replace('\\', '').lower())
+            elif record == 'CNAME':
+                post = {'target': item.target.to_unicode().strip('.').lower()}
+                records.append(post)
+            else:
+                post = {'preference': item.preference,
+                        'exchange': item.exchange.to_unicode().lower().strip('.')}
+                records.append(post)
+
+    return records or None
+
+
+def resolve_many(domains, records=RECORD_TYPES, chunk_size=CHUNK_SIZE, **kwargs):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    engine = AsyncResolver(**kwargs)
+
+    try:
+        loop.run_until_complete(engine.open())
+        chunk = []
+
+        for domain in domains:
+            chunk.append(domain)
+
+            if len(chunk) >= chunk_size:
+                yield from loop.run_until_complete(engine.resolve_all(chunk, records))
+                chunk = []
+
+        if chunk:
+            yield from loop.run_until_complete(engine.resolve_all(chunk, records))
+    finally:
+        engine.close()
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+
+def resolve_records(domain, records=RECORD_TYPES, **kwargs):
+    for _, answers in resolve_many([domain], records, **kwargs):
+        return answers
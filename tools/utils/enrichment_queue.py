@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+QUEUE_KEY = 'enrichment-queue'
+QUEUED_KEY = 'enrichment-queued'
+PENDING_PREFIX = 'enrichment-pending-'
+RECENT_PREFIX = 'enrichment-recent-'
+DONE_PREFIX = 'enrichment-done-'
+PENDING_TIMEOUT = 600
+COOLDOWN = 3600
+
+# the queued set mirrors the list and the pending key covers the enrichment itself,
+# so a domain is pushed at most once until a worker has completed it
+ENQUEUE_SCRIPT = '''
+local added = {}
+for i = 3, #ARGV do
+    local domain = ARGV[i]
+    added[i - 2] = 0
+    if redis.call('exists', ARGV[1] .. domain, ARGV[2] .. domain) == 0 and redis.call('sadd', KEYS[2], domain) == 1 then
+        redis.call('lpush', KEYS[1], domain)
+        added[i - 2] = 1
+    end
+end
+return added
+'''
+
+
+def enqueue_many(cache, domains):
+    if not domains:
+        return []
+
+    added = cache.eval(ENQUEUE_SCRIPT, 2, QUEUE_KEY, QUEUED_KEY, RECENT_PREFIX, PENDING_PREFIX, *domains)
+
+    return [bool(flag) for flag in added]
+
+
+def enqueue(cache, domain):
+    return enqueue_many(cache, [domain])[0]
+
+
+def dequeue(cache, timeout=5, pending_timeout=PENDING_TIMEOUT):
+    item = cache.brpop(QUEUE_KEY, timeout=timeout)
+
+    if item is None:
+        return None
+
+    domain = item[1].decode('utf-8')
+
+    # the pending key covers the domain while it is enriched, it can be queued again once it expires
+    pipe = cache.pipeline()
+    pipe.set(PENDING_PREFIX + domain, 1, ex=pending_timeout)
+    pipe.srem(QUEUED_KEY, domain)
+    pipe.execute()
+
+    return domain
+
+
+def complete(cache, domain, cooldown=COOLDOWN):
+    pipe = cache.pipeline()
+    pipe.set(RECENT_PREFIX + domain, 1, ex=cooldown)
+    pipe.set(DONE_PREFIX + domain, 1, ex=cooldown)
+    pipe.delete(PENDING_PREFIX + domain)
+    pipe.execute()
+
+
+def is_pending(cache, domain):
+    pipe = cache.pipeline(transaction=False)
+    pipe.sismember(QUEUED_KEY, domain)
+    pipe.exists(PENDING_PREFIX + domain)
+    queued, pending = pipe.execute()
+
+    return bool(queued) or pending > 0
+
+
+def consume_done(cache, domain):
+    return cache.delete(DONE_PREFIX + domain) > 0
@@ -3,11 +3,21 @@
 
 import re
 import ssl
+import json
 import socket
+import hashlib
 import argparse
+import threading
 
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
+from pymongo import UpdateOne
 from pymongo.errors import DuplicateKeyError
+from pymongo.errors import BulkWriteError
 from pymongo.errors import ServerSelectionTimeoutError
 from pymongo.errors import NotMasterError
 
@@ -15,19 +25,23 @@ from datetime import datetime
 from ssl import SSLError
 
 
-socket.setdefaulttimeout(1)
-
+TIMEOUT = 1
+CONCURRENCY = 100
+CACHE_SIZE = 100000
+FLUSH_SIZE = 500
+MIGRATION_ID = 'certificates'
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
+contexts = []
+certificates = {}
+lock = threading.Lock()
 
 
 def retrieve_domains(db):
-    return db.dns.find({'ssl': {'$exists': False}, 'domain': {
+    return db.dns.find({'certificate': {'$exists': False}, 'ssl': {'$exists': False}, 'domain': {
                         '$regex': '^(([\w]*\.)?(?!(xn--)+)[\w]*\.[\w]+)$'},
-                        'cert_scan_failed': {'$exists': False},
+                        'ssl_scan_failed': {'$exists': False},
                         'ports.port': {'$in': [443]}
-                        }).sort([('updated', -1)])
+                        }, {'domain': 1}).sort([('updated', -1)])
 
 
 def update_data(db, domain, post):
@@ -38,23 +52,46 @@ def update_data(db, domain, post):
         pass
 
 
-def extract_certificate(domain):
-    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-    context.verify_mode = ssl.CERT_REQUIRED
-    context.check_hostname = False
-    context.load_default_certs()
-    context.set_ciphers('ECDHE+AESGCM:!ECDSA')
+def shared_context():
+    with lock:
+        if not contexts:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = False
+            context.load_default_certs()
+            context.set_ciphers('ECDHE+AESGCM:!ECDSA')
+            contexts.append(context)
+
+    return contexts[0]
 
-    s = context.wrap_socket(socket.socket(), server_hostname=domain)
 
+def extract_certificate(domain):
     try:
-        s.connect((domain, 443))
-        cert = s.getpeercert(binary_form=False)
-        cipher = s.shared_ciphers()
-        s.close()
-    except (ConnectionRefusedError, OSError, SSLError, socket.gaierror, socket.timeout):
+        with socket.create_connection((domain, 443), timeout=TIMEOUT) as sock:
+            with shared_context().wrap_socket(sock, server_hostname=domain) as s:
+                der = s.getpeercert(binary_form=True)
+                fingerprint = hashlib.sha256(der).hexdigest()
+
+                # certificates shared by cdns and wildcard hosts are parsed once
+                if fingerprint in certificates:
+                    return certificates[fingerprint]
+
+                cert = s.getpeercert(binary_form=False)
+    except (ConnectionRefusedError, OSError, SSLError, socket.gaierror, socket.timeout, ValueError):
         return
 
+    post = format_certificate(cert)
+    post['fingerprint'] = fingerprint
+
+    if len(certificates) >= CACHE_SIZE:
+        certificates.clear()
+
+    certificates[fingerprint] = post
+
+    return post
+
+
+def format_certificate(cert):
     issuer = {}
     subject = {}
     alt_names = []
@@ -67,7 +104,7 @@ def extract_certificate(domain):
         issuer['_'.join(re.findall('.[^A-Z]*', item[0][0])
                         ).lower()] = item[0][1]
 
-    for item in cert['subjectAltName']:
+    for item in cert.get('subjectAltName', []):
         alt_names.append(item[1])
 
     post = {
@@ -92,18 +129,130 @@ def extract_certificate(domain):
     return post
 
 
-def handle_certificate(db, domain, date):
+def legacy_fingerprint(cert):
+    # certificates stored before fingerprints were recorded are keyed by issuer and serial
+    issuer = json.dumps(cert.get('issuer', {}), sort_keys=True)
+
+    return 'legacy-{}'.format(hashlib.sha256('{}{}'.format(issuer, cert.get('serial')).encode('utf-8')).hexdigest())
+
+
+def store_certificate(cert, date):
+    return UpdateOne({'_id': cert['fingerprint']}, {'$setOnInsert': dict(cert, created=date),
+                                                    '$set': {'updated': date}}, upsert=True)
+
+
+def link_certificate(domain, cert, date):
+    if cert:
+        return UpdateOne({'domain': domain}, {'$set': {'certificate': cert['fingerprint'], 'updated': date},
+                                              '$unset': {'ssl': ''}}, upsert=False)
+
+    return UpdateOne({'domain': domain}, {'$set': {'ssl_scan_failed': date}}, upsert=False)
+
+
+def certificate_post(db, domain, date):
     cert = extract_certificate(domain)
 
     if cert:
-        update_data(db, domain, {'ssl': cert, 'updated': date})
-    else:
-        update_data(db, domain, {'ssl_scan_failed': date})
+        try:
+            db.certificates.bulk_write([store_certificate(cert, date)])
+        except BulkWriteError:
+            # a concurrent upsert of the same fingerprint won the race on _id
+            if db.certificates.find_one({'_id': cert['fingerprint']}, {'_id': 1}) is None:
+                raise
+
+        return {'certificate': cert['fingerprint'], 'updated': date}
+
+    return {'ssl_scan_failed': date}
+
+
+def handle_certificate(db, domain, date):
+    update_data(db, domain, certificate_post(db, domain, date))
+
+
+def scan_certificate(domain):
+    return domain, extract_certificate(domain)
+
+
+def write_certificates(db, results):
+    date = datetime.utcnow()
+    certs = {cert['fingerprint']: cert for domain, cert in results if cert}
+
+    try:
+        if certs:
+            db.certificates.bulk_write([store_certificate(cert, date) for cert in certs.values()], ordered=False)
+    except BulkWriteError as e:
+        # concurrent upserts of a shared certificate lose the race on _id
+        errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+
+        if errors:
+            print(u'ERROR: could not write {} certificates'.format(len(errors)))
+
+    try:
+        db.dns.bulk_write([link_certificate(domain, cert, date) for domain, cert in results], ordered=False)
+    except BulkWriteError as e:
+        print(u'ERROR: could not link {} certificates'.format(len(e.details['writeErrors'])))
+
+    print(u'INFO: updated {} domains with {} distinct ssl certs'.format(len(results), len(certs)))
+
+
+def migrate_certificates(db):
+    results = []
+
+    for doc in db.dns.find({'ssl': {'$exists': True}}, {'domain': 1, 'ssl': 1}):
+        cert = doc['ssl']
+        cert.setdefault('fingerprint', legacy_fingerprint(cert))
+        results.append((doc['domain'], cert))
+
+        if len(results) >= FLUSH_SIZE:
+            write_certificates(db, results)
+            results = []
+
+    if results:
+        write_certificates(db, results)
+
+    # readers stop matching embedded ssl subdocuments once none are left
+    if db.dns.find_one({'ssl': {'$exists': True}}, {'_id': 1}) is None:
+        db.migrations.update_one({'_id': MIGRATION_ID}, {'$set': {'finished': datetime.utcnow()}}, upsert=True)
+        print(u'INFO: finished certificate migration')
+
+
+def certificates_migrated(db):
+    return db.migrations.find_one({'_id': MIGRATION_ID}, {'_id': 1}) is not None
+
+
+def harvest_certificates(db, domains, concurrency):
+    results = []
+    futures = set()
+
+    def collect(done):
+        for future in done:
+            results.append(future.result())
+
+        if len(results) >= FLUSH_SIZE:
+            write_certificates(db, results)
+            results.clear()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for domain in domains:
+            futures.add(executor.submit(scan_certificate, domain))
+
+            if len(futures) >= concurrency * 2:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        collect(wait(futures).done)
+
+    if results:
+        write_certificates(db, results)
 
 
 def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', help='set the host', type=str, required=True)
+    parser.add_argument('--concurrency', help='set the concurrent handshakes',
+                        type=int, default=CONCURRENCY)
+    parser.add_argument('--migrate', help='move embedded ssl subdocuments into the certificates collection',
+                        action='store_true')
     args = parser.parse_args()
 
     return args
@@ -114,8 +263,11 @@ def main():
     client = connect(args.host)
     db = client.ip_data
 
-    for domain in retrieve_domains(db):
-        handle_certificate(db, domain['domain'], datetime.utcnow())
+    if args.migrate:
+        migrate_certificates(db)
+    else:
+        domains = (domain['domain'] for domain in retrieve_domains(db))
+        harvest_certificates(db, domains, args.concurrency)
 
     client.close()
 
@@ -3,17 +3,17 @@
 import logging
 import certstream
 import argparse
+import functools
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
 from pymongo.errors import DuplicateKeyError
 
 from datetime import datetime
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def add_domain(db, domain):
     try:
         db.dns.insert_one({'domain': domain, 'created': datetime.utcnow()})
@@ -21,14 +21,9 @@ def add_domain(db, domain):
         print(e)
 
 
-def print_callback(message, context):
+def print_callback(db, message, context):
     logging.debug("Message -> {}".format(message))
 
-    args = argparser()
-    client = connect(args.host)
-    db = client.ip_data
-    db.dns.create_index('domain', unique=True)
-
     if message['message_type'] == "heartbeat":
         return
 
@@ -49,8 +44,6 @@ def print_callback(message, context):
             add_domain(db, domain)
             print(domain)
 
-    client.close()
-
 
 def argparser():
     parser = argparse.ArgumentParser()
@@ -65,8 +58,16 @@ def main():
         format='[%(levelname)s:%(name)s] %(asctime)s - %(message)s',
         level=logging.INFO)
 
-    certstream.listen_for_events(
-        print_callback, url='wss://certstream.calidog.io')
+    args = argparser()
+    client = connect(args.host)
+    db = client.ip_data
+    db.dns.create_index('domain', unique=True)
+
+    try:
+        certstream.listen_for_events(
+            functools.partial(print_callback, db), url='wss://certstream.calidog.io')
+    finally:
+        client.close()
 
 
 if __name__ == '__main__':
@@ -2,12 +2,16 @@
 
 import argparse
 import ipaddress
-import multiprocessing
+import numpy as np
 import pandas as pd
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+    from .partition import Checkpoint, run_workers
+except ImportError:
+    from connection import connect
+    from partition import Checkpoint, run_workers
 from pymongo.errors import DuplicateKeyError
-from pymongo.errors import CursorNotFound
 
 from geoip2 import database
 from geoip2.errors import AddressNotFoundError
@@ -15,13 +19,12 @@ from geoip2.errors import AddressNotFoundError
 from datetime import datetime
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
+BATCH_SIZE = 1000
 
 
-def retrieve_domains(db, skip, limit):
-    return db.dns.find({'a_record.0': {'$exists': True},
-                        'city': {'$exists': False}})[limit - skip:limit]
+def retrieve_domains(db, checkpoint):
+    return checkpoint.find(db.dns, {'a_record.0': {'$exists': True},
+                                    'city': {'$exists': False}})
 
 
 def update_data(db, ip, post):
@@ -36,47 +39,101 @@ def update_data(db, ip, post):
 
 
 def read_dataframe(input):
-    return pd.read_csv(input, header=None, sep=',')
+    return build_index(pd.read_csv(input, header=None, sep=','))
+
+
+def build_index(df):
+    df = df.sort_values(0)
+
+    return {'start': df[0].to_numpy(dtype=np.int64),
+            'end': df[1].to_numpy(dtype=np.int64),
+            'rows': df[[2, 3, 4, 5, 6, 7]].to_numpy()}
+
+
+def lookup_positions(df, addresses):
+    addresses = np.asarray(addresses, dtype=np.int64)
+    positions = np.searchsorted(df['start'], addresses, side='right') - 1
+    found = (positions >= 0) & (df['end'][positions.clip(0)] >= addresses)
+
+    return np.where(found, positions, -1)
+
+
+def format_geodata(row):
+    return {'country_code': row[0],
+            'country': row[1],
+            'state': row[2],
+            'city': row[3],
+            'loc': {
+                'coordinates': [round(row[5], 5), round(row[4], 5)]
+            }}
 
 
 def lookup_geodata(df, l):
-    return df.loc[(df[0].astype(int) < l) & (df[1].astype(int) > l)]
+    position = lookup_positions(df, [l])[0]
+
+    if position < 0:
+        return None
+
+    return format_geodata(df['rows'][position])
+
+
+def lookup_geodata_many(df, ips):
+    addresses = []
+
+    for ip in ips:
+        try:
+            addresses.append(convert_address(ip))
+        except ValueError:
+            addresses.append(-1)
+
+    return [format_geodata(df['rows'][p]) if p >= 0 else None for p in lookup_positions(df, addresses)]
 
 
 def convert_address(ip):
     return int(ipaddress.IPv4Address(ip))
 
 
+def geodata_post(ip, df, date):
+    geo = lookup_geodata(df, convert_address(ip))
+
+    if geo:
+        return {'geo': geo, 'updated': date}
+
+    return {}
+
+
 def extract_geodata(db, ip, df):
-    l = convert_address(ip)
-    r = lookup_geodata(df, l)
+    post = geodata_post(ip, df, datetime.utcnow())
 
-    if not r.empty:
-        update_data(db, ip, {'geo': {'country_code': r[2].iloc[0],
-                                     'country': r[3].iloc[0],
-                                     'state': r[4].iloc[0],
-                                     'city': r[5].iloc[0],
-                                     'loc': {
-                                         'coordinates': [round(r[7].iloc[0], 5),
-                                                         round(r[6].iloc[0], 5)]
-                                     }}, 'updated': datetime.utcnow()})
+    if post:
+        update_data(db, ip, post)
 
 
-def worker(host, skip, limit, df):
-    args = argparser()
-    client = connect(args.host)
+def extract_geodata_many(db, ips, df):
+    for ip, geo in zip(ips, lookup_geodata_many(df, ips)):
+        if geo:
+            update_data(db, ip, {'geo': geo, 'updated': datetime.utcnow()})
+
+
+def worker(host, df, spec):
+    client = connect(host)
     db = client.ip_data
+    checkpoint = Checkpoint(client, spec, auto=False)
+    ips = []
 
-    try:
-        domains = retrieve_domains(db, limit, skip)
+    for domain in retrieve_domains(db, checkpoint):
+        ips.extend(domain['a_record'])
+
+        if len(ips) >= BATCH_SIZE:
+            extract_geodata_many(db, ips, df)
+            checkpoint.save()
+            ips = []
 
-        for domain in domains:
-            for ip in domain['a_record']:
-                extract_geodata(db, ip, df)
+    if ips:
+        extract_geodata_many(db, ips, df)
 
-        client.close()
-    except CursorNotFound:
-        return
+    checkpoint.finish()
+    client.close()
 
 
 def argparser():
@@ -98,19 +155,5 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db.dns.estimated_document_count() / threads)
-    limit = amount
-
-    for f in range(threads):
-        j = multiprocessing.Process(
-            target=worker, args=(args.host, limit, amount, df))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        j.join()
-        client.close()
-        print('exitcode = {}'.format(j.exitcode))
+    run_workers('extract_geodata', worker, db.dns, args.worker, args.host, df)
+    client.close()
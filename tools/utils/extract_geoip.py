@@ -1,24 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
-import multiprocessing
 
 from geoip2 import database
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+    from .partition import Checkpoint, run_workers
+except ImportError:
+    from connection import connect
+    from partition import Checkpoint, run_workers
 from pymongo.errors import DuplicateKeyError
-from pymongo.errors import CursorNotFound
 
 from geoip2.errors import AddressNotFoundError
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
-def retrieve_domains(db, skip, limit):
-    return db.dns.find({'a_record.0': {'$exists': True},
-                        'country_code': {'$exists': False}})[limit - skip:limit]
+def retrieve_domains(db, checkpoint):
+    return checkpoint.find(db.dns, {'a_record.0': {'$exists': True},
+                                    'country_code': {'$exists': False}})
 
 
 def update_data(db, ip, post):
@@ -45,21 +44,17 @@ def extract_geodata(db, ip, input):
         update_data(db, ip, {'country_code': country_code})
 
 
-def worker(host, skip, limit):
-    args = argparser()
-    client = connect(args.host)
+def worker(host, input, spec):
+    client = connect(host)
     db = client.ip_data
+    checkpoint = Checkpoint(client, spec)
 
-    try:
-        domains = retrieve_domains(db, limit, skip)
-
-        for domain in domains:
-            for ip in domain['a_record']:
-                extract_geodata(db, ip, args.input)
+    for domain in retrieve_domains(db, checkpoint):
+        for ip in domain['a_record']:
+            extract_geodata(db, ip, input)
 
-        client.close()
-    except CursorNotFound:
-        return
+    checkpoint.finish()
+    client.close()
 
 
 def argparser():
@@ -77,18 +72,5 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db.dns.estimated_document_count() / threads)
-    limit = amount
-
-    for f in range(threads):
-        j = multiprocessing.Process(target=worker, args=(args.host, limit, amount))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        j.join()
-        client.close()
-        print('exitcode = {}'.format(j.exitcode))
+    run_workers('extract_geoip', worker, db.dns, args.worker, args.host, args.input)
+    client.close()
@@ -5,17 +5,33 @@ import multiprocessing
 import argparse
 
 from datetime import datetime
-from pymongo import MongoClient
+try:
+    from .connection import connect
+    from .extract_certificate import certificates_migrated
+except ImportError:
+    from connection import connect
+    from extract_certificate import certificates_migrated
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
+def certificate_stages(db):
+    # domains are related by a subject alt name shared between their certificates
+    stages = [{'$lookup': {'from': 'certificates', 'localField': 'certificate', 'foreignField': '_id', 'as': '_certificate'}},
+              {'$addFields': {'_sans': {'$ifNull': [{'$arrayElemAt': ['$_certificate.subject_alt_names', 0]},
+                                                    {'$ifNull': ['$ssl.subject_alt_names', []]}]}}},
+              {'$graphLookup': {'from': 'certificates', 'startWith': '$_sans', 'maxDepth': 0,
+                                'connectFromField': 'subject_alt_names', 'connectToField': 'subject_alt_names', 'as': '_shared'}},
+              {'$graphLookup': {'from': 'dns', 'startWith': '$_shared._id', 'maxDepth': 0,
+                                'connectFromField': 'certificate', 'connectToField': 'certificate', 'as': 'certificates'}}]
+
+    if certificates_migrated(db):
+        return stages + [{'$addFields': {'legacy_certificates': []}}]
+
+    return stages + [{'$graphLookup': {'from': 'dns', 'startWith': '$_sans', 'connectFromField': 'domain',
+                                       'connectToField': 'ssl.subject_alt_names', 'as': 'legacy_certificates'}}]
 
 
 def retrieve_entries(db, domain):
-    return db.dns.aggregate([{'$match': {'domain': domain}},
-                             {'$graphLookup': {'from': 'dns', 'startWith': '$ssl.subject_alt_names',
-                                               'connectFromField': 'domain', 'connectToField': 'ssl.subject_alt_names', 'as': 'certificates'}},
+    return db.dns.aggregate([{'$match': {'domain': domain}}] + certificate_stages(db) + [
                              {'$graphLookup': {'from': 'dns', 'startWith': '$cname_record.target',
                                                'connectFromField': 'domain', 'connectToField': 'cname_record.target', 'as': 'cname_records'}},
                              {'$graphLookup': {'from': 'dns', 'startWith': '$mx_record.exchange',
@@ -25,7 +41,7 @@ def retrieve_entries(db, domain):
                              {'$project': {
                                  'main.domain': '$domain',
                                  'main.a_record': '$a_record',
-                                 'zzz': {'$setUnion': ['$certificates', '$cname_records', '$mx_records', '$ns_records']}
+                                 'zzz': {'$setUnion': ['$certificates', '$legacy_certificates', '$cname_records', '$mx_records', '$ns_records']}
                              }},
                              {'$unwind': '$zzz'},
                              {'$group': {
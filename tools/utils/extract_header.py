@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
+import random
+import asyncio
+import aiohttp
 import requests
-import multiprocessing
 import argparse
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+    from .partition import Checkpoint, run_workers
+except ImportError:
+    from connection import connect
+    from partition import Checkpoint, run_workers
+from pymongo import UpdateOne
 from pymongo.errors import DuplicateKeyError
-from pymongo.errors import CursorNotFound
 from pymongo.errors import WriteError
+from pymongo.errors import BulkWriteError
 
 from requests.exceptions import InvalidURL
 from requests.exceptions import ReadTimeout
@@ -19,8 +27,19 @@ from fake_useragent import UserAgent
 from datetime import datetime
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
+AGENT_POOL_SIZE = 100
+CHUNK_SIZE = 5000
+TIMEOUT = 1
+
+agents = []
+
+
+def random_agent():
+    if not agents:
+        ua = UserAgent()
+        agents.extend(set(ua.random for _ in range(AGENT_POOL_SIZE)))
+
+    return random.choice(agents)
 
 
 def update_data(db, domain, post):
@@ -37,23 +56,21 @@ def update_data(db, domain, post):
         pass
 
 
-def retrieve_domains(db, skip, limit):
-    return db.dns.find({'header': {'$exists': False},
-                        'header_scan_failed': {'$exists': False},
-                        'ports.port': {'$in': [80, 443]}})[limit - skip:limit]
+def retrieve_domains(db, checkpoint):
+    return checkpoint.find(db.dns, {'header': {'$exists': False},
+                                    'header_scan_failed': {'$exists': False},
+                                    'ports.port': {'$in': [80, 443]}})
 
 
-def extract_header(db, domain, date):
-    ua = UserAgent()
+def header_post(domain, date):
     headers = []
 
     try:
-        h = {'User-Agent': ua.random}
+        h = {'User-Agent': random_agent()}
         r = requests.head(u'http://{}'.format(domain),
-                          timeout=1, allow_redirects=False, headers=h)
+                          timeout=TIMEOUT, allow_redirects=False, headers=h)
     except (InvalidHeader, InvalidURL, ReadTimeout, ConnectionError, ChunkedEncodingError):
-        update_data(db, domain, {'header_scan_failed': date})
-        return
+        return {'header_scan_failed': date}
 
     try:
         http = {'version': '{}.{}'.format(
@@ -63,28 +80,141 @@ def extract_header(db, domain, date):
         headers.update(status)
         headers.update(http)
     except UnicodeDecodeError:
-        return
+        return {}
 
     if headers:
-        update_data(db, domain, {'header': headers, 'updated': date})
-    else:
-        update_data(db, domain, {'header_scan_failed': date})
+        return {'header': headers, 'updated': date}
 
+    return {'header_scan_failed': date}
 
-def worker(host, skip, limit):
-    args = argparser()
-    client = connect(args.host)
-    db = client.ip_data
+
+def extract_header(db, domain, date):
+    post = header_post(domain, date)
+
+    if post:
+        update_data(db, domain, post)
+
+    return post
+
+
+class HeaderScanner:
+    def __init__(self, concurrency, per_ip):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.per_ip = per_ip
+        self.hosts = {}
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0),
+                                             timeout=aiohttp.ClientTimeout(total=TIMEOUT))
+
+    def host_semaphore(self, ip):
+        if ip not in self.hosts:
+            self.hosts[ip] = asyncio.Semaphore(self.per_ip)
+
+        return self.hosts[ip]
+
+    async def fetch(self, domain, ip, date):
+        url = u'http://{}/'.format(ip or domain)
+
+        # the timeout only starts once both slots are held, queued requests do not fail
+        async with self.semaphore, self.host_semaphore(ip or domain):
+            try:
+                async with self.session.head(url, allow_redirects=False,
+                                             headers={'Host': domain, 'User-Agent': random_agent()}) as r:
+                    headers = {k.lower(): v for k, v in r.headers.items()}
+                    headers['status'] = '{}'.format(r.status)
+                    headers['version'] = '{}.{}'.format(r.version.major, r.version.minor)
+
+                # undecodable bytes are kept as surrogates, which bson refuses to encode
+                for v in headers.values():
+                    v.encode('utf-8')
+            except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeError, ValueError):
+                return {'header_scan_failed': date}
+
+        return {'header': headers, 'updated': date}
+
+    async def fetch_all(self, domains):
+        date = datetime.utcnow()
+
+        try:
+            return await asyncio.gather(*[self.fetch(domain['domain'], (domain.get('a_record') or [None])[0], date)
+                                          for domain in domains])
+        finally:
+            # no request of the chunk holds a host slot anymore, the next chunk starts afresh
+            self.hosts.clear()
+
+    async def close(self):
+        await self.session.close()
+
+
+async def open_scanner(concurrency, per_ip):
+    return HeaderScanner(concurrency, per_ip)
+
+
+def write_headers(db, domains, posts):
+    operations = [UpdateOne({'domain': domain}, {'$set': post}, upsert=False)
+                  for domain, post in zip(domains, posts)]
+
+    try:
+        db.dns.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # oversized or invalid headers are flagged like in the blocking scanner
+        for error in e.details['writeErrors']:
+            if error['code'] != 11000:
+                db.dns.update_one({'domain': domains[error['index']]},
+                                  {'$set': {'header_scan_failed': datetime.utcnow()}}, upsert=False)
+
+
+def scan_headers(db, checkpoint, concurrency, per_ip):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    scanner = loop.run_until_complete(open_scanner(concurrency, per_ip))
+    chunk = []
+
+    def flush(chunk):
+        posts = loop.run_until_complete(scanner.fetch_all(chunk))
+        failed = sum(1 for post in posts if 'header' not in post)
+
+        write_headers(db, [domain['domain'] for domain in chunk], posts)
+        checkpoint.error('header_scan_failed', failed)
+        checkpoint.save()
+
+        print(u'INFO: scanned {} headers, {} failed'.format(len(posts), failed))
 
     try:
-        domains = retrieve_domains(db, limit, skip)
-    except CursorNotFound:
+        for domain in retrieve_domains(db, checkpoint):
+            chunk.append(domain)
+
+            if len(chunk) >= CHUNK_SIZE:
+                flush(chunk)
+                chunk = []
+
+        if chunk:
+            flush(chunk)
+    finally:
+        loop.run_until_complete(scanner.close())
+        loop.close()
+
+
+def worker(host, options, spec):
+    client = connect(host)
+    db = client.ip_data
+
+    if options['concurrency'] > 0:
+        checkpoint = Checkpoint(client, spec, auto=False)
+        scan_headers(db, checkpoint, options['concurrency'], options['per_ip'])
+        checkpoint.finish()
+        client.close()
         return
 
-    for domain in domains:
+    checkpoint = Checkpoint(client, spec)
+
+    for domain in retrieve_domains(db, checkpoint):
         print(u'INFO: scanning {} header'.format(domain['domain']))
-        extract_header(db, domain['domain'], datetime.utcnow())
+        post = extract_header(db, domain['domain'], datetime.utcnow())
+
+        if 'header' not in post:
+            checkpoint.error('header_scan_failed')
 
+    checkpoint.finish()
     client.close()
     return
 
@@ -94,6 +224,10 @@ def argparser():
     parser.add_argument('--worker', help='set worker count',
                         type=int, required=True)
     parser.add_argument('--host', help='set the host', type=str, required=True)
+    parser.add_argument('--concurrency', help='scan asynchronously with this many requests in flight',
+                        type=int, default=0)
+    parser.add_argument('--per-ip', help='set the concurrent requests per ip',
+                        type=int, default=4)
     args = parser.parse_args()
 
     return args
@@ -104,19 +238,7 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db.dns.estimated_document_count() / (threads + 50000))
-    limit = amount
+    options = {'concurrency': args.concurrency, 'per_ip': args.per_ip}
 
-    for f in range(threads):
-        j = multiprocessing.Process(
-            target=worker, args=(args.host, limit, amount))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        j.join()
-        client.close()
-        print('exitcode = {}'.format(j.exitcode))
+    run_workers('extract_header', worker, db.dns, args.worker, args.host, options)
+    client.close()
@@ -1,159 +1,153 @@
 #!/usr/bin/env python3
 
-import multiprocessing
+import time
 import argparse
 
-from dns import resolver
-from dns.name import EmptyLabel
-from dns.name import LabelTooLong
-from dns.resolver import NoAnswer
-from dns.resolver import NXDOMAIN
-from dns.resolver import NoNameservers
-from dns.exception import Timeout
+from collections import deque, Counter
 
 from datetime import datetime
 
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+try:
+    from .connection import connect
+    from .dns_engine import resolve_many, resolve_records
+    from .partition import Checkpoint, run_workers
+    from .ip_index import write_index
+except ImportError:
+    from connection import connect
+    from dns_engine import resolve_many, resolve_records
+    from partition import Checkpoint, run_workers
+    from ip_index import write_index
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
+RECORD_FIELDS = [('A', 'a_record'), ('AAAA', 'aaaa_record'), ('NS', 'ns_record'),
+                 ('MX', 'mx_record'), ('SOA', 'soa_record'), ('CNAME', 'cname_record')]
 
+FLUSH_SIZE = 1000
+FLUSH_INTERVAL = 1
 
-def update_data(db, domain, date, type, record):
-    try:
-        return db.dns.update_one({'domain': domain}, {'$set': {'updated': date},
-                                                      '$addToSet': {type: record}}, upsert=False)
-    except DuplicateKeyError:
-        return
 
+class RecordWriter:
+    def __init__(self, db, size=FLUSH_SIZE, interval=FLUSH_INTERVAL, callback=None):
+        self.db = db
+        self.size = size
+        self.interval = interval
+        self.callback = callback
+        self.position = None
+        self.operations = []
+        self.addresses = Counter()
+        self.flushed = time.monotonic()
 
-def update_failed(db, type, domain, post):
-    if type is not None:
-        db.dns.update_one({type: domain}, {'$set': post}, upsert=False)
+    def add(self, operations, addresses=()):
+        self.operations.extend(operations)
+        self.addresses.update(addresses)
 
+        if len(self.operations) >= self.size or time.monotonic() - self.flushed >= self.interval:
+            self.flush()
 
-def add_data(db, domain, post):
-    try:
-        post['domain'] = domain.lower()
-        post['created'] = datetime.utcnow()
-        post_id = db.dns.insert_one(post)
-    except DuplicateKeyError:
-        return
+    def flush(self):
+        operations, self.operations = self.operations, []
+        addresses, self.addresses = self.addresses, Counter()
+        self.flushed = time.monotonic()
 
+        if operations:
+            write_operations(self.db, operations)
 
-def retrieve_domains(db, skip, limit):
-    return db.dns.find({'updated': {'$exists': False}}).sort([('$natural', -1)])[limit - skip:limit]
+        if addresses:
+            write_index(self.db, addresses, datetime.utcnow())
 
+        # everything up to position is written, so progress can be recorded
+        if self.callback is not None and self.position is not None:
+            self.callback(last=self.position)
 
-def retrieve_records(domain, record):
-    records = []
 
+def write_operations(db, operations):
     try:
-        res = resolver.Resolver()
-        res.timeout = 1
-        res.lifetime = 1
-        items = res.query(domain, record)
-
-        for item in items:
-            if record not in ['MX', 'NS', 'SOA', 'CNAME']:
-                records.append(item.address)
-            elif record == 'NS':
-                records.append(item.target.to_unicode().strip('.').lower())
-            elif record == 'SOA':
-                if len(records) > 0:
-                    records[0] = item.to_text().replace('\\', '').lower()
-                else:
-                    records.append(item.to_text().replace('\\', '').lower())
-            elif record == 'CNAME':
-                post = {'target': item.target.to_unicode().strip('.').lower()}
-                records.append(post)
-            else:
-                post = {'preference': item.preference,
-                        'exchange': item.exchange.to_unicode().lower().strip('.')}
-                records.append(post)
-
-        return records
-    except (Timeout, LabelTooLong, NoNameservers, EmptyLabel, NoAnswer, NXDOMAIN):
-        return
+        return db.dns.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # concurrent upserts of the same domain lose the race on the unique index
+        errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+
+        if errors:
+            print(u'ERROR: bulk write failed, {}'.format(errors[0]['errmsg']))
+
+
+def update_data(domain, date, post):
+    return UpdateOne({'domain': domain}, {'$set': {'updated': date},
+                                          '$setOnInsert': {'created': date},
+                                          '$addToSet': post}, upsert=True)
+
+
+def update_failed(type, domain, post):
+    return UpdateOne({type: domain}, {'$set': post}, upsert=False)
+
+
+def retrieve_domains(db, checkpoint):
+    return checkpoint.find(db.dns, {'updated': {'$exists': False}}, {'domain': 1, 'a_record': 1})
+
+
+def known_addresses(db, domain):
+    doc = db.dns.find_one({'domain': domain}, {'a_record': 1})
+
+    return doc.get('a_record', []) if doc else []
 
 
-def handle_records(db, domain, date, type=None, record=None):
-    a_records = retrieve_records(domain, 'A')
-    ns_records = retrieve_records(domain, 'NS')
-    mx_records = retrieve_records(domain, 'MX')
-    soa_records = retrieve_records(domain, 'SOA')
-    aaaa_records = retrieve_records(domain, 'AAAA')
-    cname_records = retrieve_records(domain, 'CNAME')
-
-    if a_records:
-        for a_record in a_records:
-            data = update_data(db, domain, date, 'a_record', a_record)
-
-            if data.modified_count == 0:
-                add_data(db, domain, {'a_record': a_records})
-            else:
-                print(u'INFO: updated {}, A record with {}'.format(domain, a_record))
-
-    if aaaa_records:
-        for aaaa_record in aaaa_records:
-            data = update_data(db, domain, date, 'aaaa_record', aaaa_record)
-
-            if data.modified_count == 0:
-                add_data(db, domain, {'aaaa_record': aaaa_records})
-            else:
-                print(u'INFO: updated {}, AAAA record with {}'.format(domain, aaaa_record))
-
-    if ns_records:
-        for ns_record in ns_records:
-            data = update_data(db, domain, date, 'ns_record', ns_record)
-
-            if data.modified_count == 0:
-                add_data(db, domain, {'ns_record': ns_records})
-            else:
-                print(u'INFO: updated {}, NS record with {}'.format(domain, ns_record))
-
-    if mx_records:
-        for mx_record in mx_records:
-            data = update_data(db, domain, date, 'mx_record', mx_record)
-
-            if data.modified_count == 0:
-                add_data(db, domain, {'mx_record': mx_records})
-            else:
-                print(u'INFO: updated {}, MX record with {}'.format(domain, mx_record))
-
-    if soa_records:
-        for soa_record in soa_records:
-            data = update_data(db, domain, date, 'soa_record', soa_record)
-
-            if data.modified_count == 0:
-                add_data(db, domain, {'soa_record': soa_records})
-            else:
-                print(u'INFO: updated {}, SOA record with {}'.format(domain, soa_record))
-
-    if cname_records:
-        for cname_record in cname_records:
-            data = update_data(db, domain, date, 'cname_record', cname_record)
-
-            if data.modified_count == 0:
-                add_data(db, domain, {'cname_record': cname_records})
-            else:
-                print(u'INFO: updated {}, CNAME record with {}'.format(domain, cname_record))
-
-    if not any([a_records, aaaa_records, mx_records, ns_records, soa_records, cname_records]):
-        update_failed(db, type, domain, {record: datetime.utcnow()})
+def handle_records(db, domain, date, type=None, record=None, records=None, writer=None, known=None):
+    if records is None:
+        records = resolve_records(domain)
+
+    if known is None:
+        known = known_addresses(db, domain)
+
+    addresses = [ip for ip in dict.fromkeys(records.get('A') or []) if ip not in known]
+
+    post = {field: {'$each': records[name]} for name, field in RECORD_FIELDS if records.get(name)}
+    operations = []
+
+    if post:
+        operations.append(update_data(domain, date, post))
+        print(u'INFO: updated {}, {} records'.format(domain, ', '.join(name for name, field in RECORD_FIELDS if records.get(name))))
+    else:
+        if type is not None:
+            operations.append(update_failed(type, domain, {record: datetime.utcnow()}))
+
         print(u'INFO: coud not find any records for domain {}'.format(domain))
 
+    if not operations:
+        return
 
-def worker(host, skip, limit):
-    client = connect(args.host)
+    if writer is None:
+        write_operations(db, operations)
+
+        if addresses:
+            write_index(db, Counter(addresses), date)
+    else:
+        writer.add(operations, addresses)
+
+
+def worker(host, options, spec):
+    client = connect(host)
     db = client.ip_data
+    checkpoint = Checkpoint(client, spec, auto=False)
+    writer = RecordWriter(db, callback=checkpoint.save)
+    ids = deque()
+
+    def domains():
+        for domain in retrieve_domains(db, checkpoint):
+            ids.append((domain['_id'], domain.get('a_record', [])))
+            yield domain['domain']
 
-    domains = retrieve_domains(db, limit, skip)
+    for domain, records in resolve_many(domains(), **options):
+        id, known = ids.popleft()
+        handle_records(db, domain, datetime.utcnow(), records=records, writer=writer, known=known)
+        writer.position = id
 
-    for domain in domains:
-        handle_records(db, domain['domain'], datetime.utcnow())
+        if not any(records.values()):
+            checkpoint.error('no_records')
+
+    writer.flush()
+    checkpoint.finish()
 
     client.close()
     return
@@ -164,6 +158,11 @@ def argparser():
     parser.add_argument('--worker', help='set worker count',
                         type=int, required=True)
     parser.add_argument('--host', help='set the host', type=str, required=True)
+    parser.add_argument('--nameserver', help='set a nameserver, may be repeated',
+                        type=str, action='append')
+    parser.add_argument('--port', help='set the nameserver port', type=int, default=53)
+    parser.add_argument('--window', help='set the in-flight query window', type=int, default=1000)
+    parser.add_argument('--rate', help='set the queries per second per nameserver', type=int, default=10000)
     args = parser.parse_args()
 
     return args
@@ -174,19 +173,8 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db.dns.estimated_document_count() / threads)
-    limit = amount
-
-    for f in range(threads):
-        j = multiprocessing.Process(
-            target=worker, args=(args.host, limit, amount))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        j.join()
-        client.close()
-        print('exitcode = {}'.format(j.exitcode))
+    options = {'nameservers': args.nameserver, 'port': args.port,
+               'window': args.window, 'rate': args.rate}
+
+    run_workers('extract_records', worker, db.dns, args.worker, args.host, options)
+    client.close()
@@ -2,7 +2,6 @@
 
 import argparse
 import ipaddress
-import multiprocessing
 import argparse
 
 from ipwhois.net import Net
@@ -11,26 +10,31 @@ from ipwhois.exceptions import ASNOriginLookupError
 
 from ipaddress import AddressValueError
 
-from pymongo import MongoClient
-from pymongo.errors import CursorNotFound
+try:
+    from .connection import connect
+    from .partition import Checkpoint, run_workers
+    from .asn_lookup import lookup_many
+except ImportError:
+    from connection import connect
+    from partition import Checkpoint, run_workers
+    from asn_lookup import lookup_many
+from pymongo import UpdateOne
 from pymongo.errors import DuplicateKeyError
 from pymongo.errors import DocumentTooLarge
 
 from datetime import datetime
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
+BATCH_SIZE = 1000
 
 
-def retrieve_dns(db, limit, skip):
-    return db.dns.find({'whois.asn': {'$exists': False},
-                        'a_record.0': {'$exists': True}
-                        }).sort([('updated', -1)])[limit - skip:limit]
+def retrieve_dns(db, checkpoint):
+    return checkpoint.find(db.dns, {'whois.asn': {'$exists': False},
+                                    'a_record.0': {'$exists': True}})
 
 
-def retrieve_asns(db, limit, skip):
-    return db.lookup.find({'whois.asn': {'$exists': False}})[limit - skip:limit]
+def retrieve_asns(db, checkpoint):
+    return checkpoint.find(db.lookup, {'whois.asn': {'$exists': False}})
 
 
 def update_data_dns(db, ip, post):
@@ -80,36 +84,84 @@ def get_cidr(ip, asn):
         pass
 
 
+def offline_post(res):
+    if not res['asn']:
+        return {}
+
+    return {'whois.asn': str(res['asn']), 'whois.asn_cidr': res['prefix'], 'whois.asn_description': res['name']}
+
+
+def whois_post(ip, date):
+    return offline_post(lookup_many([ip])[0])
+
+
+def update_offline(db, col, docs, date, checkpoint):
+    ips = [doc['ip'] if col == 'lookup' else doc['a_record'][0] for doc in docs]
+    operations = []
+
+    for doc, res in zip(docs, lookup_many(ips)):
+        post = offline_post(res)
+
+        if post:
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': dict(post, updated=date)}))
+        else:
+            checkpoint.error('whois_not_found')
+
+    if operations:
+        res = db[col].bulk_write(operations, ordered=False)
+        print(u'INFO: updated offline whois of {} {} documents'.format(res.modified_count, col))
+
+
+def offline_worker(db, col, checkpoint, date):
+    retrieve = retrieve_asns if col == 'lookup' else retrieve_dns
+    docs = []
+
+    for doc in retrieve(db, checkpoint):
+        docs.append(doc)
+
+        if len(docs) >= BATCH_SIZE:
+            update_offline(db, col, docs, date, checkpoint)
+            checkpoint.save()
+            docs = []
+
+    if docs:
+        update_offline(db, col, docs, date, checkpoint)
+
+
 def handle_whois(db, ip, date):
     whois = get_whois(ip)
 
     if whois and len(whois) > 0:
         update_data_dns(db, ip, {'updated': date, 'whois': whois})
 
+    return whois
+
 
-def worker(host, limit, skip, col):
+def worker(host, col, offline, spec):
     client = connect(host)
     db = client.ip_data
+    checkpoint = Checkpoint(client, spec, auto=not offline)
     date = datetime.utcnow()
 
-    if col == 'lookup':
-        try:
-            for asn in retrieve_asns(db, limit, skip):
-                whois = get_whois(asn['ip'])
-                cidr = get_cidr(asn['ip'], asn['asn'])
+    if offline:
+        offline_worker(db, col, checkpoint, date)
 
-                if whois and cidr and len(whois) > 0:
-                    update_data_lookup(db, asn['asn'], {'updated': date, 'cidr': cidr, 'whois': whois})
-        except CursorNotFound:
-            pass
+    elif col == 'lookup':
+        for asn in retrieve_asns(db, checkpoint):
+            whois = get_whois(asn['ip'])
+            cidr = get_cidr(asn['ip'], asn['asn'])
+
+            if whois and cidr and len(whois) > 0:
+                update_data_lookup(db, asn['asn'], {'updated': date, 'cidr': cidr, 'whois': whois})
+            else:
+                checkpoint.error('whois_not_found')
 
     elif col == 'dns':
-        try:
-            for dns in retrieve_dns(db, limit, skip):
-                handle_whois(db, dns['a_record'][0], date)
-        except CursorNotFound:
-            pass
+        for dns in retrieve_dns(db, checkpoint):
+            if not handle_whois(db, dns['a_record'][0], date):
+                checkpoint.error('whois_not_found')
 
+    checkpoint.finish()
     client.close()
 
 
@@ -118,6 +170,8 @@ def argparser():
     parser.add_argument('--collection', help='set collection to update', type=str, required=True)
     parser.add_argument('--worker', help='set worker count', type=int, required=True)
     parser.add_argument('--host', help='set the host', type=str, required=True)
+    parser.add_argument('--offline', help='fill asn and prefix from the local prefix table instead of whois',
+                        action='store_true')
     args = parser.parse_args()
 
     return args
@@ -128,19 +182,5 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db[args.collection].estimated_document_count() / (threads + 50000))
-    limit = amount
-    print(limit, amount)
-
-    for f in range(threads):
-        j = multiprocessing.Process(target=worker, args=(args.host, limit, amount, args.collection))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        j.join()
-        client.close()
-        print('exitcode = {}'.format(j.exitcode))
+    run_workers('extract_whois-{}'.format(args.collection), worker, db[args.collection], args.worker, args.host, args.collection, args.offline)
+    client.close()
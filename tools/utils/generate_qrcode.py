@@ -1,61 +1,40 @@
 #!/usr/bin/env python3
 
+import io
 import pyqrcode
-import multiprocessing
 import argparse
 
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
-from pymongo.errors import CursorNotFound
+try:
+    from .connection import connect
+    from .partition import Checkpoint, id_range, run_workers
+except ImportError:
+    from connection import connect
+    from partition import Checkpoint, id_range, run_workers
 
-from datetime import datetime
 
+def qrcode_png(domain):
+    url = pyqrcode.create(u'https://{}'.format(domain), encoding='utf-8')
+    buffer = io.BytesIO()
+    url.png(buffer, scale=5, quiet_zone=0)
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
-def retrieve_domains(db, client, skip, limit):
-    try:
-        return db.dns.find({'qrcode': {'$exists': False}, 'domain': {
-                            '$regex': '^(([\w]*\.)?(?!(xn--)+)[\w]*\.[\w]+)$'}}).sort(
-                           [('updated', -1)])[limit - skip:limit]
-    except KeyboardInterrupt:
-        client.close()
-
+    return buffer.getvalue()
 
-def update_data(db, domain, post):
-    try:
-        res = db.dns.update_one({'domain': domain}, {'$set': post}, upsert=False)
 
-        if res.modified_count > 0:
-            print('INFO: added qrcode for domain {}'.format(domain))
-    except DuplicateKeyError:
-        return
+def purge_qrcodes(db, lower, upper):
+    res = db.dns.update_many(id_range({'qrcode': {'$exists': True}}, lower, upper),
+                             {'$unset': {'qrcode': ''}})
 
+    print('INFO: removed stored qrcode from {} documents'.format(res.modified_count))
 
-def generate_qrcode(db, domain, date):
-    url = pyqrcode.create(u'https://{}'.format(domain), encoding='utf-8')
-    qrcode = url.png_as_base64_str(scale=5, quiet_zone=0)
-    update_data(db, domain, {'updated': date, 'qrcode': qrcode})
 
-
-def worker(host, skip, limit):
+def worker(host, spec):
     client = connect(host)
     db = client.ip_data
-    date = datetime.utcnow()
-
-    try:
-        domains = retrieve_domains(db, client, limit, skip)
+    checkpoint = Checkpoint(client, spec)
 
-        for domain in domains:
-            generate_qrcode(db, domain['domain'], date)
-    except KeyboardInterrupt:
-        client.close()
-        return
-    except CursorNotFound:
-        return
+    purge_qrcodes(db, spec['lower'], spec['upper'])
 
+    checkpoint.finish()
     client.close()
     return
 
@@ -74,18 +53,5 @@ if __name__ == '__main__':
     client = connect(args.host)
     db = client.ip_data
 
-    jobs = []
-    threads = args.worker
-    amount = round(db.dns.estimated_document_count() / threads)
-    limit = amount
+    run_workers('generate_qrcode', worker, db.dns, args.worker, args.host)
     client.close()
-
-    for f in range(threads):
-        j = multiprocessing.Process(target=worker, args=(args.host, limit, amount))
-        jobs.append(j)
-        j.start()
-        limit = limit + amount
-
-    for j in jobs:
-        j.join()
-        print('exitcode = {}'.format(j.exitcode))
@@ -2,7 +2,14 @@
 
 import argparse
 
-from pymongo import MongoClient
+from datetime import datetime
+
+try:
+    from .connection import connect
+    from .ip_index import write_index
+except ImportError:
+    from connection import connect
+    from ip_index import write_index
 from pymongo.errors import DuplicateKeyError
 
 
@@ -11,10 +18,6 @@ def load(i):
         return f.readlines()
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', help='set input file name', type=str, required=True)
@@ -33,6 +36,7 @@ def main():
     for line in load(args.input):
         try:
             db.ipv4.insert_one({'ip': line.strip()})
+            write_index(db, {line.strip(): 0}, datetime.utcnow())
             print(line.strip())
         except DuplicateKeyError as e:
             print(e)
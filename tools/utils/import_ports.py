@@ -6,7 +6,10 @@ import multiprocessing
 import argparse
 import time
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
 from pymongo.errors import DuplicateKeyError
 from pymongo.errors import AutoReconnect
 
@@ -22,10 +25,6 @@ def load_document(filename):
         sys.exit(1)
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def update_data(db, col, ip, now, ports):
     try:
         if col == 'lookup':
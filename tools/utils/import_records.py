@@ -6,7 +6,12 @@ import multiprocessing
 import argparse
 import time
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+    from .ip_index import write_index
+except ImportError:
+    from connection import connect
+    from ip_index import write_index
 from pymongo.errors import DuplicateKeyError
 from pymongo.errors import AutoReconnect
 
@@ -22,10 +27,6 @@ def load_document(filename):
         sys.exit(1)
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def update_data(db, domain, record_type, now, record):
     try:
         # print({'domain': domain}, {'$set': {'updated': now}, '$addToSet': {record_type: record}})
@@ -35,6 +36,9 @@ def update_data(db, domain, record_type, now, record):
                                  {record_type: record}}, upsert=False)
         if res.modified_count > 0:
             print('INFO: updated {} document type {} for domain {}'.format(res.modified_count, record_type, domain))
+
+            if record_type == 'a_record':
+                write_index(db, {record: res.modified_count}, now)
         else:
             print('INFO: nothing to do for type {} of record {}'.format(record_type, record))
     except AutoReconnect:
@@ -2,16 +2,15 @@
 
 import argparse
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
 from pymongo.errors import DuplicateKeyError
 
 from datetime import datetime
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def add_asn(db, asn):
     try:
         now = datetime.utcnow()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import argparse
+import ipaddress
+
+from datetime import datetime
+try:
+    from .connection import connect
+    from .asn_lookup import lookup_many
+    from .prefix_index import write_prefixes
+except ImportError:
+    from connection import connect
+    from asn_lookup import lookup_many
+    from prefix_index import write_prefixes
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+BATCH_SIZE = 1000
+
+
+def ip_to_int(ip):
+    try:
+        return int(ipaddress.IPv4Address(ip))
+    except ValueError:
+        return None
+
+
+def resolve_networks(ips):
+    try:
+        return lookup_many(ips)
+    except Exception as e:
+        # the index stays usable without a rib file, the rebuild fills the asn later
+        print(u'ERROR: could not look up asn for {} ips, {}'.format(len(ips), e))
+        return [{'asn': None, 'prefix': None, 'name': None} for ip in ips]
+
+
+def network_post(network):
+    if not network['asn']:
+        return {}
+
+    return {'asn': network['asn'], 'prefix': network['prefix'], 'name': network['name']}
+
+
+def index_operations(counts, networks, date):
+    operations = []
+
+    for (ip, count), network in zip(counts, networks):
+        operations.append(UpdateOne({'_id': ip_to_int(ip)}, {'$set': {'updated': date},
+                                                             '$setOnInsert': dict(network_post(network), ip=ip),
+                                                             '$inc': {'domains': count}}, upsert=True))
+
+    return operations
+
+
+def write_index(db, counts, date):
+    counts = [(ip, count) for ip, count in counts.items() if ip_to_int(ip) is not None]
+
+    if not counts:
+        return
+
+    networks = resolve_networks([ip for ip, count in counts])
+    operations = index_operations(counts, networks, date)
+    write_prefixes(db, networks, date)
+
+    try:
+        db.ips.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # concurrent upserts of the same ip lose the race on _id
+        errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+
+        if errors:
+            print(u'ERROR: ip index write failed, {}'.format(errors[0]['errmsg']))
+
+
+def count_domains(db, ips):
+    if not ips:
+        return {}
+
+    return {doc['_id']: doc['domains'] for doc in db.dns.aggregate([{'$match': {'a_record': {'$in': ips}}},
+                                                                    {'$project': {'a_record': 1}},
+                                                                    {'$unwind': '$a_record'},
+                                                                    {'$match': {'a_record': {'$in': ips}}},
+                                                                    {'$group': {'_id': '$a_record', 'domains': {'$sum': 1}}}])}
+
+
+def update_addresses(db, posts, counts=None):
+    counts = counts or {}
+    operations = [UpdateOne({'_id': ip_to_int(post['ip'])}, {'$set': post, '$setOnInsert': {'domains': counts.get(post['ip'], 0)}},
+                            upsert=True) for post in posts if ip_to_int(post['ip']) is not None]
+
+    if not operations:
+        return
+
+    try:
+        db.ips.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # concurrent upserts of the same ip lose the race on _id
+        errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+
+        if errors:
+            print(u'ERROR: ip index write failed, {}'.format(errors[0]['errmsg']))
+
+    write_prefixes(db, posts, posts[0]['updated'])
+
+
+def find_addresses(db, ips, projection=None):
+    keys = [key for key in (ip_to_int(ip) for ip in ips) if key is not None]
+
+    return db.ips.find({'_id': {'$in': keys}}, projection)
+
+
+def rebuild_batch(db, batch, date):
+    networks = resolve_networks([ip for ip, count in batch])
+    operations = []
+
+    for (ip, count), network in zip(batch, networks):
+        post = dict(network_post(network), ip=ip, domains=count, updated=date)
+        operations.append(UpdateOne({'_id': ip_to_int(ip)}, {'$set': post}, upsert=True))
+
+    db.ips.bulk_write(operations, ordered=False)
+    write_prefixes(db, networks, date)
+
+
+def rebuild_index(db):
+    date = datetime.utcnow()
+    batch = []
+    count = 0
+
+    for doc in db.dns.aggregate([{'$match': {'a_record.0': {'$exists': True}}},
+                                 {'$project': {'a_record': 1}},
+                                 {'$unwind': '$a_record'},
+                                 {'$group': {'_id': '$a_record', 'domains': {'$sum': 1}}}], allowDiskUse=True):
+        if ip_to_int(doc['_id']) is None:
+            continue
+
+        batch.append((doc['_id'], doc['domains']))
+
+        if len(batch) >= BATCH_SIZE:
+            rebuild_batch(db, batch, date)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        rebuild_batch(db, batch, date)
+        count += len(batch)
+
+    # ips that were not touched by the rebuild or an importer since have no domains left
+    res = db.ips.update_many({'updated': {'$lt': date}}, {'$set': {'domains': 0}})
+
+    print(u'INFO: indexed {} ips, reset {} ips without domains'.format(count, res.modified_count))
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='set the host', type=str, required=True)
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = argparser()
+    client = connect(args.host)
+    db = client.ip_data
+
+    rebuild_index(db)
+    client.close()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import time
+import multiprocessing
+
+from datetime import datetime
+from pymongo.errors import CursorNotFound
+
+
+SAMPLE_SIZE = 100
+CHECKPOINT_SIZE = 1000
+CHECKPOINT_INTERVAL = 10
+
+
+def partition(collection, count, sample_size=SAMPLE_SIZE):
+    if count < 2:
+        return [(None, None)]
+
+    sample = [document['_id'] for document in collection.aggregate([
+        {'$sample': {'size': count * sample_size}},
+        {'$project': {'_id': 1}},
+        {'$sort': {'_id': 1}}], allowDiskUse=True)]
+
+    bounds = []
+
+    for i in range(1, count):
+        if not sample:
+            break
+
+        bound = sample[len(sample) * i // count]
+
+        if not bounds or bounds[-1] != bound:
+            bounds.append(bound)
+
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def id_range(query, lower, upper, last=None):
+    query = dict(query)
+    condition = {}
+
+    if last is not None:
+        condition['$gt'] = last
+    elif lower is not None:
+        condition['$gte'] = lower
+
+    if upper is not None:
+        condition['$lt'] = upper
+
+    if condition:
+        query['_id'] = condition
+
+    return query
+
+
+class Checkpoint:
+    def __init__(self, client, spec, auto=True):
+        self.checkpoints = client.ip_data.checkpoints
+        self.id = spec['_id']
+        self.lower = spec['lower']
+        self.upper = spec['upper']
+        self.last = spec['last']
+        self.processed = spec['processed']
+        self.errors = dict(spec['errors'])
+        self.auto = auto
+        self.pending = 0
+        self.saved = time.monotonic()
+
+    def find(self, collection, query, projection=None):
+        while True:
+            cursor = collection.find(id_range(query, self.lower, self.upper, self.last),
+                                     projection).sort([('_id', 1)])
+
+            try:
+                for document in cursor:
+                    yield document
+                    self.advance(document['_id'])
+
+                return
+            except CursorNotFound:
+                print(u'INFO: cursor timed out in {}, reopening after {}'.format(self.id, self.last))
+                self.error('cursor_not_found')
+
+    def advance(self, id):
+        self.last = id
+        self.processed += 1
+        self.pending += 1
+
+        if self.auto and (self.pending >= CHECKPOINT_SIZE or time.monotonic() - self.saved >= CHECKPOINT_INTERVAL):
+            self.save()
+
+    def error(self, name, count=1):
+        self.errors[name] = self.errors.get(name, 0) + count
+
+    def save(self, last=None, post=None):
+        self.pending = 0
+        self.saved = time.monotonic()
+
+        update = {'processed': self.processed, 'errors': self.errors, 'updated': datetime.utcnow()}
+        update['last'] = self.last if last is None else last
+        update.update(post or {})
+
+        self.checkpoints.update_one({'_id': self.id}, {'$set': update})
+
+    def finish(self):
+        self.save(post={'finished': datetime.utcnow()})
+
+
+def load_partitions(collection, name, count):
+    checkpoints = collection.database.client.ip_data.checkpoints
+    specs = list(checkpoints.find({'name': name, 'finished': {'$exists': False}}).sort([('_id', 1)]))
+
+    if specs:
+        print(u'INFO: resuming {} from {} unfinished partitions'.format(name, len(specs)))
+        return specs
+
+    checkpoints.delete_many({'name': name})
+    date = datetime.utcnow()
+    specs = [{'_id': '{}-{}'.format(name, i), 'name': name, 'lower': lower, 'upper': upper,
+              'last': None, 'processed': 0, 'errors': {}, 'created': date}
+             for i, (lower, upper) in enumerate(partition(collection, count))]
+    checkpoints.insert_many(specs)
+
+    return specs
+
+
+def run_workers(name, target, collection, count, *args):
+    jobs = []
+
+    for spec in load_partitions(collection, name, count):
+        j = multiprocessing.Process(target=target, args=args + (spec,))
+        jobs.append(j)
+        j.start()
+
+    for j in jobs:
+        j.join()
+        print('exitcode = {}'.format(j.exitcode))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import argparse
+import ipaddress
+
+from datetime import datetime
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+PREFIX_MODES = ['within', 'contains', 'overlaps']
+BATCH_SIZE = 1000
+
+
+def parse_network(prefix):
+    try:
+        return ipaddress.IPv4Network(prefix, strict=False)
+    except ValueError:
+        return None
+
+
+def prefix_post(network):
+    return {'cidr': str(network), 'start': int(network.network_address),
+            'end': int(network.broadcast_address), 'length': network.prefixlen}
+
+
+def supernets(network):
+    return [str(network.supernet(new_prefix=length)) for length in range(network.prefixlen + 1)]
+
+
+def prefix_queries(network, mode):
+    start, end = int(network.network_address), int(network.broadcast_address)
+
+    # a cidr block containing the network is one of its at most 33 supernets
+    contains = {'_id': {'$in': supernets(network)}}
+    within = {'start': {'$gte': start, '$lte': end}, 'end': {'$lte': end}}
+
+    if mode == 'contains':
+        return [contains]
+
+    if mode == 'within':
+        return [within]
+
+    # two cidr blocks overlap only if one contains the other
+    return [contains, within]
+
+
+def address_query(network, mode):
+    start, end = int(network.network_address), int(network.broadcast_address)
+
+    if mode == 'contains':
+        return {'_id': start} if network.prefixlen == 32 else None
+
+    return {'_id': {'$gte': start, '$lte': end}}
+
+
+def prefix_operations(networks, date):
+    operations = {}
+
+    for network in networks:
+        cidr = parse_network(network['prefix']) if network.get('prefix') else None
+
+        if cidr is None or str(cidr) in operations:
+            continue
+
+        post = prefix_post(cidr)
+
+        if network.get('asn'):
+            post.update(asn=network['asn'], name=network.get('name'))
+
+        operations[str(cidr)] = UpdateOne({'_id': str(cidr)}, {'$setOnInsert': post, '$set': {'updated': date}}, upsert=True)
+
+    return list(operations.values())
+
+
+def write_prefixes(db, networks, date):
+    operations = prefix_operations(networks, date)
+
+    if not operations:
+        return
+
+    try:
+        db.prefixes.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # concurrent upserts of the same prefix lose the race on _id
+        errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+
+        if errors:
+            print(u'ERROR: prefix index write failed, {}'.format(errors[0]['errmsg']))
+
+
+def retrieve_networks(db):
+    yield from db.ips.find({'prefix': {'$exists': True}}, {'_id': 0, 'prefix': 1, 'asn': 1, 'name': 1})
+    yield from db.lookup.aggregate([{'$match': {'cidr.0': {'$exists': True}}},
+                                    {'$unwind': '$cidr'},
+                                    {'$group': {'_id': '$cidr', 'asn': {'$first': '$asn'}, 'name': {'$first': '$name'}}},
+                                    {'$project': {'_id': 0, 'prefix': '$_id', 'asn': 1, 'name': 1}}], allowDiskUse=True)
+    yield from db.dns.aggregate([{'$match': {'whois.asn_cidr': {'$exists': True}}},
+                                 {'$group': {'_id': '$whois.asn_cidr', 'asn': {'$first': '$whois.asn'},
+                                             'name': {'$first': '$whois.asn_description'}}},
+                                 {'$project': {'_id': 0, 'prefix': '$_id', 'asn': 1, 'name': 1}}], allowDiskUse=True)
+
+
+def rebuild_prefixes(db):
+    db.prefixes.create_index([('start', ASCENDING), ('end', ASCENDING)], background=True)
+    date = datetime.utcnow()
+    batch = []
+    count = 0
+
+    for network in retrieve_networks(db):
+        batch.append(network)
+
+        if len(batch) >= BATCH_SIZE:
+            write_prefixes(db, batch, date)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        write_prefixes(db, batch, date)
+        count += len(batch)
+
+    print(u'INFO: indexed prefixes from {} networks'.format(count))
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='set the host', type=str, required=True)
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = argparser()
+    client = connect(args.host)
+    db = client.ip_data
+
+    rebuild_prefixes(db)
+    client.close()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import socket
+import argparse
+import ipaddress
+
+import numpy as np
+
+
+TABLE_PATH = os.path.join(os.path.dirname(__file__), 'prefix_table')
+TABLE_FILES = ['starts', 'values', 'networks', 'lengths', 'asns']
+ADDRESS_SPACE = 2 ** 32
+
+
+def parse_rib(path):
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith(';'):
+                continue
+
+            try:
+                prefix, asn = line.split()[:2]
+                yield ipaddress.IPv4Network(prefix), int(asn)
+            except ValueError:
+                # ipv6 prefixes and as sets have no place in the table
+                continue
+
+
+def flatten(prefixes):
+    # longest prefix match becomes a lookup in disjoint intervals, each one
+    # pointing at the most specific prefix that covers it or -1
+    starts, values = [0], [-1]
+    stack = []
+
+    def emit(position, value):
+        if position >= ADDRESS_SPACE:
+            return
+
+        if starts[-1] == position:
+            values[-1] = value
+        elif values[-1] != value:
+            starts.append(position)
+            values.append(value)
+
+        if len(values) > 1 and values[-1] == values[-2]:
+            starts.pop()
+            values.pop()
+
+    def close(start):
+        while stack and stack[-1][1] < start:
+            end = stack.pop()[1]
+            emit(end + 1, stack[-1][2] if stack else -1)
+
+    for start, end, id in prefixes:
+        close(start)
+        emit(start, id)
+        stack.append((start, end, id))
+
+    close(ADDRESS_SPACE)
+
+    return np.array(starts, dtype=np.uint32), np.array(values, dtype=np.int32)
+
+
+def build_table(rib, path=TABLE_PATH):
+    networks = {}
+
+    for network, asn in parse_rib(rib):
+        networks[network] = asn
+
+    networks = sorted(networks.items(), key=lambda item: (int(item[0].network_address), -item[0].num_addresses))
+    starts, values = flatten((int(n.network_address), int(n.broadcast_address), i) for i, (n, asn) in enumerate(networks))
+
+    arrays = {'starts': starts, 'values': values,
+              'networks': np.array([int(n.network_address) for n, asn in networks], dtype=np.uint32),
+              'lengths': np.array([n.prefixlen for n, asn in networks], dtype=np.uint8),
+              'asns': np.array([asn for n, asn in networks], dtype=np.uint32)}
+
+    # processes that mapped the old files keep reading them until they reload
+    tmp, old = '{}.tmp'.format(path), '{}.old'.format(path)
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    for name in TABLE_FILES:
+        np.save(os.path.join(tmp, '{}.npy'.format(name)), arrays[name])
+
+    if os.path.isdir(path):
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(path, old)
+
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+    print(u'INFO: built prefix table with {} prefixes and {} intervals'.format(len(networks), len(starts)))
+
+
+def encode_ips(ips):
+    packed = bytearray()
+    valid = []
+
+    for ip in ips:
+        try:
+            packed += socket.inet_pton(socket.AF_INET, ip)
+            valid.append(True)
+        except (OSError, TypeError):
+            packed += b'\0\0\0\0'
+            valid.append(False)
+
+    return np.frombuffer(bytes(packed), dtype='>u4').astype(np.uint32), valid
+
+
+class PrefixTable:
+    def __init__(self, path=TABLE_PATH):
+        self.path = path
+        self.prefixes = {}
+
+        for name in TABLE_FILES:
+            setattr(self, name, np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='r'))
+
+    def lookup_ints(self, keys):
+        return self.values[np.searchsorted(self.starts, keys, side='right') - 1]
+
+    def prefix(self, id):
+        if id not in self.prefixes:
+            self.prefixes[id] = '{}/{}'.format(socket.inet_ntoa(int(self.networks[id]).to_bytes(4, 'big')), self.lengths[id])
+
+        return self.prefixes[id]
+
+    def lookup_many(self, ips):
+        if len(self.asns) == 0:
+            return [{'asn': None, 'prefix': None} for ip in ips]
+
+        keys, valid = encode_ips(ips)
+        ids = self.lookup_ints(keys)
+        results = []
+
+        for ok, id, asn in zip(valid, ids.tolist(), self.asns[ids].tolist()):
+            if not ok or id < 0:
+                results.append({'asn': None, 'prefix': None})
+            else:
+                results.append({'asn': asn, 'prefix': self.prefix(id)})
+
+        return results
+
+
+def table_version(path=TABLE_PATH):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+def load_table(path=TABLE_PATH):
+    if not os.path.isfile(os.path.join(path, 'starts.npy')):
+        return None
+
+    return PrefixTable(path)
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', help='set the pyasn rib file name', type=str, required=True)
+    parser.add_argument('--output', help='set the table directory', type=str, default=TABLE_PATH)
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = argparser()
+
+    build_table(args.input, args.output)
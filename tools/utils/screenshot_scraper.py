@@ -13,17 +13,16 @@ from selenium.common.exceptions import JavascriptException
 from selenium.common.exceptions import StaleElementReferenceException
 from selenium.common.exceptions import UnexpectedAlertPresentException
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
 from pymongo.errors import DuplicateKeyError
 from pymongo.errors import CursorNotFound
 
 from datetime import datetime
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def retrieve_domains(db):
     return db.dns.find({'image': {'$exists': False},
                         'image_scan_failed': {'$exists': False}
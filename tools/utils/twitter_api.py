@@ -6,7 +6,10 @@ import json
 import twitter
 import argparse
 
-from pymongo import MongoClient
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
 from pymongo.errors import DuplicateKeyError
 
 from datetime import datetime
@@ -26,10 +29,6 @@ def load_document(filename):
         sys.exit(1)
 
 
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
-
-
 def connect_twitter(config):
     return twitter.Api(consumer_key=config['consumer_key'],
                        consumer_secret=config['consumer_secret'],
@@ -1,59 +1,71 @@
 #!/usr/bin/env python3
 
-from .extract_whois import handle_whois
-from .extract_header import extract_header
+from .extract_whois import whois_post
+from .extract_header import header_post
 from .extract_records import handle_records
-from .extract_geodata import extract_geodata
-from .extract_certificate import handle_certificate
-from .generate_qrcode import generate_qrcode
+from .extract_geodata import geodata_post
+from .extract_certificate import certificate_post
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pymongo import MongoClient
-
-
-def connect(host):
-    return MongoClient('mongodb://{}:27017'.format(host))
+try:
+    from .connection import connect
+except ImportError:
+    from connection import connect
+from pymongo.errors import WriteError
 
 
 def retrieve_records(db, domain):
     return list(db.dns.find({'domain': domain}, {'a_record': 1}))
 
 
-def update_header(db, domain):
-    extract_header(db, domain, datetime.utcnow())
-
-
 def update_records(db, domain, type, record):
     handle_records(db, domain, datetime.utcnow(), type, record)
 
 
-def update_qrcode(db, domain):
-    generate_qrcode(db, domain, datetime.utcnow())
+def update_data(db, domain, post):
+    try:
+        db.dns.update_one({'domain': domain}, {'$set': post}, upsert=False)
+    except WriteError:
+        if 'header' not in post:
+            raise
+
+        del post['header']
+        post['header_scan_failed'] = datetime.utcnow()
+        db.dns.update_one({'domain': domain}, {'$set': post}, upsert=False)
 
+    print(u'INFO: updated domain {} with {}'.format(domain, ', '.join(sorted(post))))
 
-def update_certificate(db, domain):
-    handle_certificate(db, domain, datetime.utcnow())
 
+def run_stages(stages):
+    post = {}
 
-def update_geodata(db, ip, df):
-    extract_geodata(db, ip, df)
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        futures = [executor.submit(stage, *args) for stage, args in stages]
 
+        for future in futures:
+            try:
+                post.update(future.result())
+            except Exception as e:
+                print(u'ERROR: enrichment stage failed, {}'.format(e))
 
-def update_whois(db, ip):
-    handle_whois(db, ip, datetime.utcnow())
+    return post
 
 
 def handle_query(domain, df, type=None, record=None):
-    client = connect('localhost')
+    client = connect()
     db = client.ip_data
+    date = datetime.utcnow()
 
     update_records(db, domain, type, record)
 
     records = retrieve_records(db, domain)
 
     if len(records) > 0 and 'a_record' in records[0]:
-        #update_whois(db, records[0]['a_record'][0])
-        update_geodata(db, records[0]['a_record'][0], df)
-        update_certificate(db, domain)
-        update_header(db, domain)
-        update_qrcode(db, domain)
+        post = run_stages([(geodata_post, (records[0]['a_record'][0], df, date)),
+                           (whois_post, (records[0]['a_record'][0], date)),
+                           (certificate_post, (db, domain, date)),
+                           (header_post, (domain, date))])
+
+        if post:
+            update_data(db, domain, post)
@@ -7,7 +7,8 @@ from aiohttp import web
 from aiohttp_wsgi import WSGIHandler
 from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timedelta
-from api import app
+from bson import json_util
+from api import app, parse_condition, match_query, export_pipelines
 
 
 @asyncio.coroutine
@@ -15,6 +16,11 @@ def setup_db():
     return AsyncIOMotorClient(app.config['MONGO_STATS_URI']).stats_data
 
 
+@asyncio.coroutine
+def setup_data_db():
+    return AsyncIOMotorClient(app.config['MONGO_URI']).get_default_database()
+
+
 class RestHandler:
     @asyncio.coroutine
     def trends(self, req):
@@ -30,6 +36,51 @@ class RestHandler:
 
         return web.json_response(document)
 
+    async def export(self, req):
+        condition, value = parse_condition(req.match_info['query'])
+        spec, query, value = match_query(condition, value)
+
+        if spec is None:
+            return web.HTTPNotFound(text='Page not found, yolo!')
+
+        try:
+            batch_size = int(req.query.get('batch_size', app.config.get('EXPORT_BATCH_SIZE', 1000)))
+        except ValueError:
+            return web.HTTPBadRequest(text='Invalid batch size')
+
+        batch_size = max(1, min(batch_size, app.config.get('EXPORT_MAX_BATCH_SIZE', 10000)))
+
+        res = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+
+        if 'gzip' in req.headers.get('accept-encoding', '') or req.query.get('compress') == 'gzip':
+            res.enable_compression(web.ContentCoding.gzip)
+
+        await res.prepare(req)
+
+        loop = asyncio.get_event_loop()
+        pipelines = export_pipelines(spec, query)
+        lines = []
+
+        while True:
+            # resolving certificate matches runs blocking queries, keep them off the event loop
+            pipeline = await loop.run_in_executor(None, next, pipelines, None)
+
+            if pipeline is None:
+                break
+
+            async for doc in req.app['data'].dns.aggregate(pipeline, batchSize=batch_size):
+                lines.append(json_util.dumps(doc))
+
+                if len(lines) >= batch_size:
+                    await res.write('{}\n'.format('\n'.join(lines)).encode('utf-8'))
+                    lines = []
+
+        if lines:
+            await res.write('{}\n'.format('\n'.join(lines)).encode('utf-8'))
+
+        await res.write_eof()
+        return res
+
 
 async def stats(req, res):
     mongo = req.app['db']
@@ -92,6 +143,7 @@ aio_handler = RestHandler()
 aioapp = web.Application()
 
 aioapp['db'] = loop.run_until_complete(setup_db())
+aioapp['data'] = loop.run_until_complete(setup_data_db())
 aioapp.on_response_prepare.append(on_prepare)
 
 cors = aiohttp_cors.setup(aioapp, defaults={
@@ -105,4 +157,7 @@ cors = aiohttp_cors.setup(aioapp, defaults={
 trends_resource = cors.add(aioapp.router.add_resource('/trends'))
 cors.add(trends_resource.add_route('GET', aio_handler.trends))
 
+export_resource = cors.add(aioapp.router.add_resource('/export/match/{query:.*}'))
+cors.add(export_resource.add_route('GET', aio_handler.export))
+
 aioapp.router.add_route('*', '/{path_info:.*}', wsgi_handler)